@@ -0,0 +1,13 @@
+import os
+from dotenv import load_dotenv
+
+
+dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
+if os.path.exists(dotenv_path):
+    load_dotenv(dotenv_path)
+
+from watchlist import create_app
+from watchlist.aio import AsyncApp
+
+#uvicorn asgi:app --workers 1
+app = AsyncApp(create_app())
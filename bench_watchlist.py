@@ -0,0 +1,290 @@
+"""Watchlist基准测试：批量生成数据，测量各个视图的吞吐量和p50/p99延迟。
+
+    python bench_watchlist.py --movies 10000 --messages 100000 --save-baseline
+    python bench_watchlist.py --movies 10000 --messages 100000 --mode both
+    python bench_watchlist.py --mode all --concurrency 64   # asgi模式需要requirements-asgi.txt
+
+结果以JSON格式写入--output，与--baseline比较，性能下降超过--tolerance时以非零状态退出。
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.cookiejar import CookieJar
+
+
+USERNAME = 'bench'
+PASSWORD = 'bench-password'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the watchlist routes.')
+    parser.add_argument('--movies', type=int, default=10000, help='Movies to seed.')
+    parser.add_argument('--messages', type=int, default=10000, help='Messages to seed.')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per scenario.')
+    parser.add_argument('--warmup', type=int, default=20, help='Unmeasured requests before each GET scenario.')
+    parser.add_argument('--concurrency', type=int, default=4, help='Client threads in server mode.')
+    parser.add_argument('--mode', choices=['inprocess', 'server', 'asgi', 'both', 'all'], default='inprocess',
+                        help='both = inprocess + server, all = inprocess + server + asgi.')
+    parser.add_argument('--no-cache', action='store_true', help='Disable the anonymous page cache.')
+    parser.add_argument('--output', default='bench_results.json', help='Where to write the JSON results.')
+    parser.add_argument('--baseline', default='bench_baseline.json', help='Baseline results to compare against.')
+    parser.add_argument('--save-baseline', action='store_true', help='Store these results as the new baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative slowdown.')
+    return parser.parse_args(argv)
+
+
+def seed(db, movies, messages, chunk_size=10000):
+    #用executemany批量插入，比forge逐个添加ORM对象快得多
+    from datetime import datetime, timedelta
+    from watchlist.models import User, Movie, MessageBoard
+    from watchlist.transfer import bulk_insert
+    from watchlist.cache import owner_cache, page_cache
+    from watchlist.spam import message_limiter, recent_hashes
+    db.drop_all()
+    db.create_all()
+    user = User(name='Benchmark', username=USERNAME)
+    user.set_password(PASSWORD)
+    db.session.add(user)
+    db.session.commit()
+    bulk_insert(Movie, (dict(title='Movie %d' % i, year=1900 + i % 120, user_id=user.id) for i in range(movies)), chunk_size)
+    start = datetime.now() - timedelta(seconds=messages)
+    bulk_insert(MessageBoard, (dict(username='user%d' % (i % 1000), content='Message number %d' % i,
+                                    ctime=start + timedelta(seconds=i)) for i in range(messages)), chunk_size)
+    owner_cache.invalidate()
+    page_cache.invalidate()
+    #每个模式都重新建库，之前模式发布过的留言内容不能被当作重复留言
+    recent_hashes.clear()
+    message_limiter.reset()
+
+
+def rejected_posts() -> int:
+    from watchlist.spam import post_counters
+    counts = post_counters.snapshot()
+    return counts['duplicate'] + counts['rate_limited']
+
+
+def scenarios(movies):
+    """(名称, 方法, 路径函数, 表单函数, 是否需要登录)，i为请求序号。"""
+    return [
+        ('index', 'GET', lambda i: '/', None, False),
+        ('index_deep', 'GET', lambda i: '/?after=%d' % (movies // 2), None, False),
+        ('messageboard', 'GET', lambda i: '/messageboard', None, False),
+        ('messageboard_post', 'POST', lambda i: '/messageboard',
+         lambda i: dict(username='bench', content='Benchmark post %d' % i), False),
+        ('edit', 'POST', lambda i: '/movie/edit/%d' % (i + 1),
+         lambda i: dict(title='Edited %d' % i, year='2000'), True),
+        ('delete', 'POST', lambda i: '/movie/delete/%d' % (movies - i), None, True),
+        ('login', 'POST', lambda i: '/login', lambda i: dict(username=USERNAME, password=PASSWORD), False),
+    ]
+
+
+class InProcessClient(object):
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None) -> int:
+        return self.client.open(path, method=method, data=data).status_code
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class ServerClient(object):
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()), _NoRedirect())
+
+    def request(self, method, path, data=None) -> int:
+        body = urllib.parse.urlencode(data).encode('utf-8') if data is not None else None
+        req = urllib.request.Request(self.base_url + path, data=body, method=method)
+        try:
+            with self.opener.open(req) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code
+
+
+def percentile(values, p) -> float:
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100.0 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def run_scenario(make_client, scenario, total, concurrency, warmup=0):
+    name, method, path, form, needs_login = scenario
+    expected = 200 if method == 'GET' else 302
+    if method == 'GET': #写操作的路径与序号有关，不预热
+        client = make_client()
+        for i in range(warmup):
+            client.request(method, path(i))
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def worker():
+        client = make_client()
+        if needs_login:
+            client.request('POST', '/login', dict(username=USERNAME, password=PASSWORD))
+        local = []
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                break
+            start = time.perf_counter()
+            status = client.request(method, path(i), form(i) if form else None)
+            local.append(time.perf_counter() - start)
+            if status != expected:
+                with lock:
+                    errors[0] += 1
+        with lock:
+            latencies.extend(local)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return dict(
+        requests=len(latencies),
+        errors=errors[0],
+        throughput=round(len(latencies) / elapsed, 2),
+        p50_ms=round(percentile(latencies, 50) * 1000, 3),
+        p99_ms=round(percentile(latencies, 99) * 1000, 3),
+    )
+
+
+def run_mode(mode, app, db, args):
+    results = {}
+    server = None
+    if mode == 'server':
+        from werkzeug.serving import make_server, WSGIRequestHandler
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+
+        server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = 'http://127.0.0.1:%d' % server.server_port
+        make_client, concurrency = (lambda: ServerClient(base_url)), args.concurrency
+    elif mode == 'asgi':
+        server, base_url = start_uvicorn(app)
+        make_client, concurrency = (lambda: ServerClient(base_url)), args.concurrency
+    else:
+        make_client, concurrency = (lambda: InProcessClient(app)), 1
+    try:
+        with app.app_context():
+            seed(db, args.movies, args.messages)
+        for scenario in scenarios(args.movies):
+            rejected = rejected_posts()
+            results[scenario[0]] = result = run_scenario(make_client, scenario, args.requests, concurrency, args.warmup)
+            #被拒绝的留言同样重定向，只能从计数判断，否则压测的是拒绝路径而不是写入
+            result['errors'] += rejected_posts() - rejected
+            print('%-10s %-18s %s' % (mode, scenario[0], results[scenario[0]]))
+    finally:
+        if server is not None:
+            server.shutdown()
+    return results
+
+
+def start_uvicorn(app):
+    #单进程uvicorn，未登录的GET请求不占用线程，并发数可以超过线程池大小
+    import socket
+    import uvicorn
+    from watchlist.aio import AsyncApp
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    server = uvicorn.Server(uvicorn.Config(AsyncApp(app), log_level='warning', access_log=False))
+    thread = threading.Thread(target=server.run, kwargs=dict(sockets=[sock]), daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+
+    class Handle(object):
+        def shutdown(self):
+            server.should_exit = True
+            thread.join()
+            sock.close()
+    return Handle(), 'http://127.0.0.1:%d' % sock.getsockname()[1]
+
+
+def compare(results, baseline, tolerance) -> list:
+    """返回性能下降的条目说明，空列表表示没有回归。"""
+    failures = []
+    for mode, scenarios_ in results.items():
+        for name, current in scenarios_.items():
+            if current['errors']:
+                failures.append('%s/%s: %d unexpected responses' % (mode, name, current['errors']))
+            base = baseline.get(mode, {}).get(name)
+            if base is None:
+                continue
+            if current['p50_ms'] > base['p50_ms'] * (1 + tolerance):
+                failures.append('%s/%s: p50 %.3fms > baseline %.3fms' % (mode, name, current['p50_ms'], base['p50_ms']))
+            if current['p99_ms'] > base['p99_ms'] * (1 + tolerance):
+                failures.append('%s/%s: p99 %.3fms > baseline %.3fms' % (mode, name, current['p99_ms'], base['p99_ms']))
+            if current['throughput'] < base['throughput'] / (1 + tolerance):
+                failures.append('%s/%s: throughput %.2f/s < baseline %.2f/s'
+                                % (mode, name, current['throughput'], base['throughput']))
+    return failures
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    tmpdir = tempfile.mkdtemp(prefix='watchlist-bench-')
+    #必须在导入watchlist之前设置，应用在导入时读取数据库配置
+    os.environ['DATABASE_FILE'] = os.path.join(tmpdir, 'bench.db')
+    os.environ.pop('DATABASE_URL', None)
+    try:
+        from wsgi import app
+        from watchlist import db
+        app.config['MESSAGE_POST_BURST'] = 0 #压测的是写入，不是限速
+        if args.no_cache:
+            app.config['PAGE_CACHE_TTL'] = 0
+        modes = dict(both=['inprocess', 'server'], all=['inprocess', 'server', 'asgi']).get(args.mode, [args.mode])
+        results = dict((mode, run_mode(mode, app, db, args)) for mode in modes)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    meta = dict(movies=args.movies, messages=args.messages, requests=args.requests,
+                concurrency=args.concurrency, no_cache=args.no_cache, python=sys.version.split()[0])
+    with open(args.output, 'w') as f:
+        json.dump(dict(meta=meta, results=results), f, indent=2, sort_keys=True)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(dict(meta=meta, results=results), f, indent=2, sort_keys=True)
+        print('Saved baseline to %s.' % args.baseline)
+        return 0
+    if not os.path.exists(args.baseline):
+        print('No baseline at %s, run with --save-baseline to create one.' % args.baseline)
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('meta', {}).get('movies') != args.movies or baseline.get('meta', {}).get('messages') != args.messages:
+        print('Warning: baseline was recorded with a different dataset size.')
+    failures = compare(results, baseline['results'], args.tolerance)
+    for failure in failures:
+        print('REGRESSION ' + failure)
+    if failures:
+        return 1
+    print('No regressions against %s.' % args.baseline)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
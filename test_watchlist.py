@@ -1,39 +1,115 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
-from watchlist import app, db
+from watchlist import create_app, db, message_writer
 from watchlist.models import Movie, User, MessageBoard
 from watchlist.commands import forge, initdb
+from watchlist.cache import owner_cache, page_cache
+from watchlist.metrics import collector
+from watchlist.routes import login_limiter
+from watchlist.spam import message_limiter, recent_hashes, post_counters
+from watchlist.templating import fragment_cache
+from watchlist.archive import segment_cache
 
 class WatchlistTestCase(unittest.TestCase):
 
     def setUp(self): #测试用例调用前执行
-        #更新配置
-        app.config.update(
+        #使用测试配置创建程序实例
+        self.app = create_app(dict(
             TESTING = True, #开启测试模式
             SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:' #使用SQLite的内存数据库
-        )
+        ))
+        self.context = self.app.app_context()
+        self.context.push()
+        #清除上一个测试用例留下的限速和去重状态，缓存和推送属于各自的应用，不需要清除
+        login_limiter.reset()
+        message_limiter.reset()
+        recent_hashes.clear()
+        post_counters.reset()
         #创建数据库和表
         db.create_all()
         #创建测试数据
         user = User(name='测试账号', username='test')
         user.set_password('123')
-        movie = Movie(title = 'Test Movie Title', year = '2020')
+        movie = Movie(title = 'Test Movie Title', year = '2020', user = user) #电影属于测试账号
         #使用add_all()方法一次添加多个model类实例，传入列表
         db.session.add_all([user, movie])
         db.session.commit()
-        self.client = app.test_client() #创建测试客户端
-        self.runner = app.test_cli_runner() #创建测试命令运行器
+        self.client = self.app.test_client() #创建测试客户端
+        self.runner = self.app.test_cli_runner() #创建测试命令运行器
 
     def tearDown(self):
         db.session.remove() #清除数据库会话
         db.drop_all() #删除数据库表
+        self.context.pop()
 
     #测试程序需实例是否存在
     def test_app_exitst(self):
-        self.assertIsNotNone(app)
+        self.assertIsNotNone(self.app)
+
+    #测试启动耗时：导入包时不加载视图，创建程序和第一个请求的耗时在合理范围内
+    def test_startup_time(self):
+        #flask命令只需要创建应用和执行命令，视图、API和请求钩子等到第一个请求才加载
+        script = '''
+import json, sys, time
+start = time.process_time() #CPU时间，受机器上其他进程的影响比墙上时间小
+import watchlist
+app = watchlist.create_app(dict(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite:///:memory:'))
+if sys.argv[1] == 'eager':
+    watchlist.init_views(app)
+output = app.test_cli_runner().invoke(args=['initdb']).output
+command = time.process_time()
+with app.app_context():
+    fts = watchlist.db.session.execute("SELECT count(*) FROM sqlite_master WHERE name = 'movie_fts'").scalar()
+web = [name for name in ('routes', 'api', 'errors', 'metrics', 'templating', 'assets', 'compress')
+       if 'watchlist.' + name in sys.modules]
+with app.app_context():
+    status = app.test_client().get('/').status_code
+done = time.process_time()
+print(json.dumps(dict(output=output, web=web, fts=fts, status=status, command_ms=(command - start) * 1000,
+                      first_request_ms=(done - command) * 1000)))
+'''
+        def run(mode):
+            output = subprocess.check_output([sys.executable, '-c', script, mode],
+                                             cwd=os.path.dirname(os.path.abspath(__file__)))
+            return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+        runs = [(run('lazy'), run('eager')) for _ in range(4)] #交替运行，两种方式受到的干扰相近
+        lazy, eager = [timing[0] for timing in runs], [timing[1] for timing in runs]
+        self.assertEqual(lazy[0]['output'], 'Initialized database.\n')
+        self.assertEqual(lazy[0]['web'], []) #命令没有加载任何视图模块
+        self.assertEqual(lazy[0]['fts'], 1) #全文索引表仍然随create_all创建
+        self.assertEqual(len(eager[0]['web']), 7)
+        self.assertEqual(lazy[0]['status'], 200)
+        #取多次运行的最小值，排除机器负载的影响
+        lazy_ms = min(timing['command_ms'] for timing in lazy)
+        eager_ms = min(timing['command_ms'] for timing in eager)
+        self.assertLess(lazy_ms, eager_ms)
+        sys.stderr.write('\nstartup: flask initdb %.1fms (with views %.1fms), first request %.1fms\n'
+                         % (lazy_ms, eager_ms, min(timing['first_request_ms'] for timing in lazy)))
+
+    #测试同一进程中的多个应用：缓存、推送和留言队列各自独立
+    def test_multiple_apps(self):
+        other = create_app(dict(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite:///:memory:',
+                                MESSAGE_BATCH_ENABLED=True))
+        for name in ('page_cache', 'owner_cache', 'message_broker', 'message_writer'):
+            self.assertIsNot(other.extensions[name], self.app.extensions[name])
+        self.assertIs(message_writer.queue(other).app, other)
+        self.assertIs(message_writer.queue(), self.app.extensions['message_writer']) #当前应用的队列
+        self.assertFalse(message_writer.enabled)
+        page_cache.set(('main.index', '/?'), b'cached', 60, 10)
+        with other.app_context():
+            self.assertIsNone(page_cache.get(('main.index', '/?')))
+            self.assertTrue(message_writer.enabled)
+        self.assertIsNotNone(page_cache.get(('main.index', '/?')))
 
     #测试程序是否处于测试模式
     def test_app_is_testing(self):
-        self.assertTrue(app.config['TESTING'])
+        self.assertTrue(self.app.config['TESTING'])
 
     #测试404页
     def test_404_page(self):
@@ -125,6 +201,553 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertNotIn('添加成功', data)
         self.assertIn('请输入适合的字段长度', data)
 
+    #测试重复留言和留言限速
+    def test_messageboard_spam(self):
+        self.app.config.update(METRICS_ENABLED=True, MESSAGE_POST_BURST=3)
+        message = dict(username='访客', content='重复的留言')
+        data = self.client.post('/messageboard', data=message, follow_redirects=True).get_data(as_text=True)
+        self.assertIn('添加成功', data)
+        data = self.client.post('/messageboard', data=message, follow_redirects=True).get_data(as_text=True)
+        self.assertIn('请不要重复留言', data)
+
+        #最近hash被清除后由唯一索引拒绝
+        recent_hashes.clear()
+        data = self.client.post('/messageboard', data=message, follow_redirects=True).get_data(as_text=True)
+        self.assertIn('请不要重复留言', data)
+        self.assertEqual(MessageBoard.query.count(), 1)
+
+        #令牌用完后拒绝
+        data = self.client.post('/messageboard', data=dict(username='访客', content='另一条'),
+                                follow_redirects=True).get_data(as_text=True)
+        self.assertIn('留言太频繁', data)
+        self.assertEqual(MessageBoard.query.count(), 1)
+
+        data = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('watchlist_message_posts_total{result="accepted"} 1', data)
+        self.assertIn('watchlist_message_posts_total{result="duplicate"} 2', data)
+        self.assertIn('watchlist_message_posts_total{result="rate_limited"} 1', data)
+
+        #写入失败时不记录hash，用户可以重试
+        message_limiter.reset()
+        db.session.execute('ALTER TABLE message_board RENAME TO message_board_old')
+        db.session.commit()
+        with self.assertRaises(Exception):
+            self.client.post('/messageboard', data=dict(username='访客', content='写入失败的留言'))
+        db.session.rollback()
+        db.session.execute('ALTER TABLE message_board_old RENAME TO message_board')
+        db.session.commit()
+        data = self.client.post('/messageboard', data=dict(username='访客', content='写入失败的留言'),
+                                follow_redirects=True).get_data(as_text=True)
+        self.assertIn('添加成功', data)
+        self.assertEqual(MessageBoard.query.count(), 2)
+
+        #批量写入时队列中的重复留言被跳过
+        message_writer.submit('访客', '重复的留言')
+        message_writer.submit('访客', '批量的新留言')
+        message_writer.flush()
+        self.assertEqual(MessageBoard.query.count(), 3)
+        self.assertIsNotNone(MessageBoard.query.filter_by(content='批量的新留言').first().content_hash)
+
+    #测试分页
+    def test_pagination(self):
+        self.app.config['MOVIES_PER_PAGE'] = 2
+        db.session.add_all([Movie(title='Paged Movie %d' % i, year='2000', user_id=1) for i in range(4)])
+        db.session.commit()
+        response = self.client.get('/')
+        data = response.get_data(as_text=True)
+        self.assertIn('5部电影', data)
+        self.assertIn('Test Movie Title', data)
+        self.assertNotIn('Paged Movie 1', data)
+        self.assertIn('下一页', data)
+        self.assertNotIn('上一页', data)
+
+        response = self.client.get('/?after=2')
+        data = response.get_data(as_text=True)
+        self.assertIn('Paged Movie 1', data)
+        self.assertIn('Paged Movie 2', data)
+        self.assertNotIn('Test Movie Title', data)
+        self.assertIn('上一页', data)
+
+        response = self.client.get('/?before=3')
+        data = response.get_data(as_text=True)
+        self.assertIn('Test Movie Title', data)
+        self.assertIn('Paged Movie 0', data)
+
+        #游标格式错误
+        response = self.client.get('/messageboard?after=bad')
+        self.assertEqual(response.status_code, 400)
+
+    #测试留言按(ctime, id)分页：时间相同的留言不会重复或遗漏，翻页查询按索引定位
+    def test_messageboard_keyset(self):
+        from datetime import datetime
+        from watchlist.database import compile_query
+        from watchlist.pagination import keyset_clauses, paginate_keyset
+        ctime = datetime(2020, 1, 1)
+        db.session.add_all([MessageBoard(username='分页', content='留言%d' % i, ctime=ctime) for i in range(5)])
+        db.session.commit()
+        columns = [MessageBoard.ctime, MessageBoard.id]
+        seen, after = [], None
+        while True:
+            page = paginate_keyset(MessageBoard.query, columns, 2, after=after, descending=True)
+            seen.extend(message.id for message in page.items)
+            if not page.next_cursor:
+                break
+            after = page.next_cursor
+        self.assertEqual(seen, [5, 4, 3, 2, 1])
+
+        criterion, order, backward, cursor = keyset_clauses(columns, '2020-01-01T00:00:00,3', None, True)
+        sql, params = compile_query(db.select([MessageBoard.__table__]).where(criterion).order_by(*order).limit(3))
+        plan = [row[-1] for row in db.session.connection().connection.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+        self.assertTrue(plan[0].startswith('SEARCH message_board USING INDEX ix_message_board_ctime'), plan)
+
+    #测试留言批量写入
+    def test_messageboard_batch(self):
+        self.app.config.update(MESSAGE_BATCH_ENABLED=True, MESSAGE_BATCH_INTERVAL=60)
+        response = self.client.post('/messageboard', data=dict(
+            username = '批量用户',
+            content = '批量写入的留言'
+        ))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(MessageBoard.query.count(), 0) #还在队列中
+
+        #重定向后的页面能看到自己的留言
+        response = self.client.get('/messageboard')
+        data = response.get_data(as_text=True)
+        self.assertIn('添加成功', data)
+        self.assertIn('批量写入的留言', data)
+        self.assertEqual(MessageBoard.query.count(), 1)
+
+        message_writer.submit('批量用户', '第二条留言')
+        self.assertEqual(message_writer.flush(), 1)
+        self.assertEqual(MessageBoard.query.count(), 2)
+
+        #其他worker进程的回执不能按本进程的序号判断，等待那条留言写入
+        self.app.config['MESSAGE_BATCH_WAIT'] = 0.1
+        pid, seq, digest = message_writer.submit('批量用户', '第三条留言')
+        message_writer.wait_for([pid + 1, 0, digest])
+        self.assertEqual(MessageBoard.query.count(), 2) #没有写入本进程的队列
+        message_writer.wait_for([pid, seq, digest])
+        self.assertEqual(MessageBoard.query.count(), 3)
+
+    #测试批量写入多次失败的留言被丢弃，不会挡住之后的留言
+    def test_messageboard_batch_failure(self):
+        self.app.config.update(MESSAGE_BATCH_ENABLED=True, MESSAGE_BATCH_INTERVAL=60, MESSAGE_BATCH_RETRIES=2)
+        db.session.execute('ALTER TABLE message_board RENAME TO message_board_old')
+        db.session.commit()
+        message_writer.submit('批量用户', '写入失败的留言')
+        for _ in range(2):
+            with self.assertRaises(Exception):
+                message_writer.flush()
+        self.assertEqual(message_writer.flush(), 0) #已丢弃
+        db.session.execute('ALTER TABLE message_board_old RENAME TO message_board')
+        db.session.commit()
+        message_writer.submit('批量用户', '之后的留言')
+        self.assertEqual(message_writer.flush(), 1)
+        self.assertEqual(MessageBoard.query.count(), 1)
+
+    #测试全文搜索
+    def test_search(self):
+        db.session.add_all([
+            Movie(title='Spirited Away', year=2001),
+            MessageBoard(username='searcher', content='hello totoro fans'),
+        ])
+        db.session.commit()
+        response = self.client.get('/search?q=spirit')
+        data = response.get_data(as_text=True)
+        self.assertIn('Spirited Away', data)
+        self.assertNotIn('Test Movie Title', data)
+
+        response = self.client.get('/search?q=totoro&kind=message')
+        self.assertIn('hello totoro fans', response.get_data(as_text=True))
+
+        #触发器同步更新和删除
+        movie = Movie.query.filter_by(title='Spirited Away').first()
+        movie.title = 'Castle in the Sky'
+        db.session.commit()
+        self.assertNotIn('Castle in the Sky', self.client.get('/search?q=spirit').get_data(as_text=True))
+        self.assertIn('Castle in the Sky', self.client.get('/search?q=castle').get_data(as_text=True))
+        db.session.delete(movie)
+        db.session.commit()
+        self.assertIn('没有找到相关结果', self.client.get('/search?q=castle').get_data(as_text=True))
+
+        #FTS5语法字符不会导致错误
+        response = self.client.get('/search?q=%22AND(')
+        self.assertEqual(response.status_code, 200)
+
+    #测试中文留言搜索：trigram可以匹配任意位置的子串，少于3个字的词用LIKE匹配
+    def test_search_chinese(self):
+        db.session.add(MessageBoard(username='影迷', content='这部电影很好看'))
+        db.session.commit()
+        for q in ('这部', '电影', '好看', '部电影很', '电影 好看'):
+            data = self.client.get('/search', query_string=dict(q=q, kind='message')).get_data(as_text=True)
+            self.assertIn('这部电影很好看', data)
+        data = self.client.get('/search', query_string=dict(q='电影 难看', kind='message')).get_data(as_text=True)
+        self.assertNotIn('这部电影很好看', data)
+
+        #只有短词时只在最近的行中查找，页面上说明；有长词时由全文索引匹配，不受限制
+        self.app.config['SEARCH_SCAN_ROWS'] = 1
+        db.session.add(MessageBoard(username='影迷', content='新的留言'))
+        db.session.commit()
+        data = self.client.get('/search', query_string=dict(q='电影', kind='message')).get_data(as_text=True)
+        self.assertNotIn('这部电影很好看', data)
+        self.assertIn('只在最近的1条中查找', data)
+        data = self.client.get('/search', query_string=dict(q='电影很', kind='message')).get_data(as_text=True)
+        self.assertIn('这部电影很好看', data)
+        self.assertNotIn('只在最近的', data)
+        self.app.config['SEARCH_SCAN_ROWS'] = 20000
+
+        #旧的unicode61索引由migratedb换成默认的分词器
+        self.app.config['SEARCH_TOKENIZER'] = 'unicode61'
+        self.runner.invoke(args=['reindex'])
+        self.assertNotIn('这部电影很好看', self.client.get('/search', query_string=dict(q='很好看', kind='message'))
+                         .get_data(as_text=True))
+        self.app.config['SEARCH_TOKENIZER'] = ''
+        self.assertIn('Applied create_search_index.', self.runner.invoke(args=['migratedb']).output)
+        self.assertIn('这部电影很好看', self.client.get('/search', query_string=dict(q='很好看', kind='message'))
+                      .get_data(as_text=True))
+
+    #测试重建搜索索引
+    def test_reindex_command(self):
+        result = self.runner.invoke(args=['reindex'])
+        self.assertIn('Rebuilt movie_fts.', result.output)
+        self.assertIn('Test Movie Title', self.client.get('/search?q=test').get_data(as_text=True))
+
+    #测试JSON接口
+    def test_api(self):
+        db.session.add_all([Movie(title='Api Movie %d' % i, year=2000 + i, user_id=1) for i in range(3)])
+        db.session.add(MessageBoard(username='api', content='api message'))
+        db.session.commit()
+        response = self.client.get('/api/movies?limit=2&fields=id,title')
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual(data['total'], 4)
+        self.assertEqual(data['items'], [{'id': 1, 'title': 'Test Movie Title'}, {'id': 2, 'title': 'Api Movie 0'}])
+        response = self.client.get('/api/movies?limit=2&after=' + data['next'])
+        self.assertEqual([item['year'] for item in response.get_json()['items']], [2001, 2002])
+
+        #数据未变化时返回304
+        response = self.client.get('/api/messages')
+        self.assertEqual(response.get_json()['items'][0]['content'], 'api message')
+        etag = response.headers['ETag']
+        self.assertIn('Last-Modified', response.headers)
+        response = self.client.get('/api/messages', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.client.post('/messageboard', data=dict(username='api', content='new message'))
+        response = self.client.get('/api/messages', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        #参数错误时即使ETag匹配也返回400
+        etag = response.headers['ETag']
+        response = self.client.get('/api/messages', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        for query in ('fields=password', 'after=bad'):
+            response = self.client.get('/api/messages?' + query, headers={'If-None-Match': '*'})
+            self.assertEqual(response.status_code, 400)
+
+        #gzip压缩
+        self.app.config['COMPRESS_MIN_SIZE'] = 0
+        response = self.client.get('/api/movies', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+
+        response = self.client.get('/api/movies?fields=password')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['error'], 'bad request')
+
+    #测试性能统计
+    def test_metrics(self):
+        response = self.client.get('/')
+        self.assertNotIn('Server-Timing', response.headers)
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+        self.app.config.update(METRICS_ENABLED=True, PAGE_CACHE_TTL=0)
+        collector.reset()
+        response = self.client.get('/')
+        self.assertIn('db;dur=', response.headers['Server-Timing'])
+        self.assertIn('render;dur=', response.headers['Server-Timing'])
+        self.assertGreater(collector.snapshot()['main.index']['queries'], 0)
+        data = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('watchlist_requests_total{endpoint="main.index"} 1', data)
+        self.assertIn('watchlist_db_queries_total{endpoint="main.index"}', data)
+
+    #测试留言实时推送
+    def test_message_stream(self):
+        self.app.config.update(SSE_STREAM_TIMEOUT=0.3, SSE_HEARTBEAT=0.1, SSE_POLL_INTERVAL=60)
+        self.assertNotIn('EventSource', self.client.get('/messageboard').get_data(as_text=True)) #WSGI下默认不开启
+        self.assertEqual(self.client.get('/messageboard/stream').status_code, 404)
+        self.app.config['SSE_ENABLED'] = True
+        self.client.post('/messageboard', data=dict(username='推送', content='第一条留言'))
+        response = self.client.get('/messageboard/stream?last_id=0')
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        data = response.get_data(as_text=True)
+        self.assertIn('id: 1\nevent: message\n', data)
+        self.assertIn('第一条留言', data)
+
+        #只推送Last-Event-ID之后的留言
+        self.client.post('/messageboard', data=dict(username='推送', content='第二条留言'))
+        response = self.client.get('/messageboard/stream', headers={'Last-Event-ID': '1'})
+        data = response.get_data(as_text=True)
+        self.assertNotIn('第一条留言', data)
+        self.assertIn('第二条留言', data)
+
+        #没有新留言时只发送心跳
+        data = self.client.get('/messageboard/stream').get_data(as_text=True)
+        self.assertNotIn('event: message', data)
+        self.assertIn(': ping', data)
+
+    #测试多用户：每个用户有自己的清单，只能修改自己的电影
+    def test_multiple_users(self):
+        result = self.runner.invoke(args=['add-user', '--username', 'alice', '--name', 'Alice', '--password', '456'])
+        self.assertIn('Created user alice', result.output)
+        result = self.runner.invoke(args=['add-user', '--username', 'alice', '--name', 'Alice', '--password', '456'])
+        self.assertIn('already exists', result.output)
+        alice = User.query.filter_by(username='alice').first()
+        db.session.add(Movie(title='Alice Movie', year=2010, user=alice))
+        db.session.commit()
+
+        #未登录时首页显示站长的清单，/u/用户名 显示其他用户的清单
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('Test Movie Title', data)
+        self.assertNotIn('Alice Movie', data)
+        data = self.client.get('/u/alice').get_data(as_text=True)
+        self.assertIn('Alice的电影清单', data)
+        self.assertIn('1部电影', data)
+        self.assertIn('Alice Movie', data)
+        self.assertNotIn('Test Movie Title', data)
+        self.assertEqual(self.client.get('/u/nobody').status_code, 404)
+
+        #登录后首页显示自己的清单，新电影属于自己
+        self.client.post('/login', data=dict(username='alice', password='456'))
+        self.client.post('/', data=dict(title='Alice Second', year='2011'))
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('Alice Second', data)
+        self.assertNotIn('Test Movie Title', data)
+        self.assertIn('<title>Alice的电影清单</title>', self.client.get('/settings').get_data(as_text=True))
+        self.assertEqual(Movie.query.filter_by(title='Alice Second').first().user_id, alice.id)
+        #其他用户的清单没有编辑按钮，也不能修改
+        self.assertNotIn('编辑', self.client.get('/u/test').get_data(as_text=True))
+        self.assertEqual(self.client.post('/movie/delete/1').status_code, 404)
+        self.assertEqual(self.client.get('/movie/edit/1').status_code, 404)
+        self.assertIsNotNone(Movie.query.get(1))
+
+        response = self.client.get('/api/movies?user=alice')
+        self.assertEqual([item['title'] for item in response.get_json()['items']], ['Alice Movie', 'Alice Second'])
+
+    #测试留言归档：旧留言移入gzip分段，归档页面仍可查看
+    def test_archive_messages_command(self):
+        from datetime import datetime, timedelta
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.app.config.update(ARCHIVE_DIR=tmpdir, MESSAGES_PER_PAGE=2)
+        old = datetime.now() - timedelta(days=30)
+        db.session.add_all([MessageBoard(username='旧', content='旧留言%d' % i, ctime=old + timedelta(minutes=i))
+                            for i in range(5)])
+        db.session.add(MessageBoard(username='新', content='新留言'))
+        db.session.commit()
+        result = self.runner.invoke(args=['archive-messages', '--older-than', '7', '--batch-size', '2'])
+        self.assertIn('Archived 5 messages', result.output)
+        self.assertIn('Database compacted with vacuum.', result.output)
+        self.assertEqual(MessageBoard.query.count(), 1)
+        self.assertEqual(sorted(os.listdir(tmpdir)), ['index.json'] + ['messages-%06d.jsonl.gz' % seq for seq in (1, 2, 3)])
+
+        #归档列表从index.json读取行数和起止时间，不解压分段
+        segment_cache.clear()
+        data = self.client.get('/messageboard/archive').get_data(as_text=True)
+        self.assertIn('2条', data)
+        self.assertEqual(len(segment_cache), 0)
+
+        self.assertIn('查看更早的归档留言', self.client.get('/messageboard').get_data(as_text=True))
+        data = self.client.get('/messageboard/archive').get_data(as_text=True)
+        self.assertIn('/messageboard/archive/3', data)
+        data = self.client.get('/messageboard/archive/1').get_data(as_text=True)
+        self.assertIn('旧留言1', data)
+        self.assertNotIn('旧留言2', data)
+        data = self.client.get('/messageboard/archive/3').get_data(as_text=True)
+        self.assertIn('旧留言4', data)
+        self.assertEqual(self.client.get('/messageboard/archive/4').status_code, 404)
+
+        #写完分段后中断，行还在数据库中，再次执行时只删除不重复归档
+        db.session.add(MessageBoard(id=5, username='旧', content='旧留言4', ctime=old + timedelta(minutes=4)))
+        db.session.commit()
+        result = self.runner.invoke(args=['archive-messages', '--older-than', '7'])
+        self.assertIn('Archived 0 messages', result.output)
+        self.assertEqual(MessageBoard.query.count(), 1)
+        self.assertEqual(len(os.listdir(tmpdir)), 4)
+
+        #旧版本没有index.json，再次归档时补齐
+        os.remove(os.path.join(tmpdir, 'index.json'))
+        self.runner.invoke(args=['archive-messages', '--older-than', '7', '--no-vacuum'])
+        with open(os.path.join(tmpdir, 'index.json'), encoding='utf-8') as f:
+            self.assertEqual(sorted(json.load(f)), ['1', '2', '3'])
+
+    #测试响应压缩和流式渲染
+    def test_compression(self):
+        import gzip
+        db.session.add_all([MessageBoard(username='压缩', content='压缩测试留言%d' % i) for i in range(20)])
+        db.session.commit()
+        response = self.client.get('/messageboard', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertIn('压缩测试留言19', gzip.decompress(response.get_data()).decode('utf-8'))
+        #页面缓存命中时直接使用保存的压缩结果，不再重新压缩
+        entry = page_cache.get(('main.messageboard', '/messageboard?'))
+        self.assertEqual(entry.variants['gzip'], response.get_data())
+        entry.variants['gzip'] = gzip.compress(entry.body)
+        response = self.client.get('/messageboard', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['X-Cache'], 'HIT')
+        self.assertEqual(response.get_data(), entry.variants['gzip'])
+        #压缩后为弱ETag，仍然可以返回304
+        etag = response.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        response = self.client.get('/messageboard', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        #不支持压缩的客户端和太小的响应不压缩
+        self.assertNotIn('Content-Encoding', self.client.get('/messageboard').headers)
+        self.app.config['COMPRESS_MIN_SIZE'] = 10 ** 6
+        response = self.client.get('/login', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+        #登录后的页面不进入缓存，流式渲染并逐块压缩
+        self.app.config.update(STREAM_TEMPLATES=True, COMPRESS_MIN_SIZE=1024)
+        self.login()
+        self.client.get('/') #显示登录成功的闪现消息
+        response = self.client.get('/messageboard', headers={'Accept-Encoding': 'gzip'})
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        data = gzip.decompress(response.get_data()).decode('utf-8')
+        self.assertIn('压缩测试留言0', data)
+        self.assertTrue(data.rstrip().endswith('</html>'))
+
+    #测试列表行片段缓存：行更新后updated_at变化，只重新渲染该行
+    def test_fragment_cache(self):
+        self.app.config['PAGE_CACHE_TTL'] = 0
+        self.client.get('/')
+        keys = fragment_cache.keys()
+        self.assertEqual(len(keys), 1)
+        self.assertEqual(keys[0][:2], ('_movie_row.html', 1))
+        self.client.get('/')
+        self.assertEqual(fragment_cache.keys(), keys)
+
+        #登录后的行有编辑按钮，缓存键不同
+        self.login()
+        self.assertIn('编辑', self.client.get('/').get_data(as_text=True))
+        self.client.post('/movie/edit/1', data=dict(title='Fragment Edited', year='2001'))
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('Fragment Edited', data)
+        self.assertNotIn('Test Movie Title', data)
+        self.assertEqual(len(fragment_cache), 3)
+
+    #测试静态文件构建：带哈希的地址、预压缩版本和永久缓存
+    def test_build_assets_command(self):
+        import gzip
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        static_folder = os.path.join(tmpdir, 'static')
+        shutil.copytree(self.app.static_folder, static_folder, ignore=shutil.ignore_patterns('dist'))
+        self.app.static_folder = static_folder
+        result = self.runner.invoke(args=['build-assets'])
+        self.assertEqual(result.exit_code, 0)
+        manifest = self.app.extensions['assets']
+        self.assertRegex(manifest['style.css'], r'^dist/style\.[0-9a-f]{12}\.css$')
+        self.assertIn('style.css -> ' + manifest['style.css'], result.output)
+
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('/static/' + manifest['style.css'], data)
+        self.assertIn('/static/' + manifest['images/avatar.png'], data)
+
+        response = self.client.get('/static/' + manifest['style.css'], headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertEqual(response.mimetype, 'text/css')
+        with open(os.path.join(static_folder, 'style.css'), 'rb') as f:
+            self.assertEqual(gzip.decompress(response.get_data()), f.read())
+        response.close()
+
+        #不支持压缩的客户端得到原文件
+        response = self.client.get('/static/' + manifest['style.css'])
+        self.assertNotIn('Content-Encoding', response.headers)
+        response.close()
+
+        #重新构建时保留旧的带哈希文件，已缓存旧页面的浏览器仍能加载
+        with open(os.path.join(static_folder, 'style.css'), 'a', encoding='utf-8') as f:
+            f.write('\nbody { margin: 0; }\n')
+        result = self.runner.invoke(args=['build-assets'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertNotEqual(self.app.extensions['assets']['style.css'], manifest['style.css'])
+        self.assertTrue(os.path.exists(os.path.join(static_folder, *manifest['style.css'].split('/'))))
+        self.assertTrue(os.path.exists(os.path.join(static_folder, *self.app.extensions['assets']['style.css'].split('/'))))
+
+    #测试ASGI入口：未登录的GET请求由aiosqlite异步查询，其他请求交给WSGI应用
+    def test_asgi_app(self):
+        import asyncio
+        from watchlist.aio import AsyncApp
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        app = create_app(dict(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(tmpdir, 'asgi.db')))
+        db.session.remove() #会话按线程复用，切换到文件数据库的程序实例前先移除
+        with app.app_context():
+            db.create_all()
+            owner = User(name='异步站长', username='async')
+            db.session.add_all([owner, Movie(title='Async Movie', year=2021, user=owner),
+                                Movie(title='Other User Movie', year=2021), MessageBoard(username='异步', content='异步留言')])
+            db.session.commit()
+            db.session.remove()
+        owner_cache.invalidate()
+        asgi_app = AsyncApp(app)
+
+        async def call(path, query=b'', headers=()):
+            messages = []
+            received = []
+            async def receive(): #请求体读完之后一直等到连接断开
+                if received:
+                    await asyncio.Event().wait()
+                received.append(True)
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            async def send(message):
+                messages.append(message)
+            scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+                     'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'root_path': '',
+                     'query_string': query, 'headers': list(headers),
+                     'server': ('127.0.0.1', 80), 'client': ('127.0.0.1', 12345)}
+            await asgi_app(scope, receive, send)
+            body = b''.join(message.get('body', b'') for message in messages[1:])
+            return messages[0]['status'], dict(messages[0]['headers']), body.decode('utf-8')
+
+        async def run():
+            try:
+                results = [await call('/'), await call('/'), await call('/messageboard')]
+                etag = results[0][1][b'etag']
+                results.append(await call('/', headers=[(b'if-none-match', etag)]))
+                results.append(await call('/', query=b'after=abc'))
+                results.append(await call('/login'))
+                #大量空闲的推送连接不占用线程池，其他请求照常处理
+                app.config.update(SSE_STREAM_TIMEOUT=2, SSE_HEARTBEAT=0.1, SSE_POLL_INTERVAL=60)
+                streams = [asyncio.ensure_future(call('/messageboard/stream', b'last_id=0')) for _ in range(40)]
+                await asyncio.sleep(0.2)
+                results.append(await asyncio.wait_for(call('/login'), 1))
+                results.append(await streams[0])
+                await asyncio.gather(*streams)
+                return results
+            finally:
+                await asgi_app.pool.close()
+
+        first, second, messages, not_modified, bad_cursor, login, busy_login, stream = asyncio.run(run())
+        self.assertEqual(first[0], 200)
+        self.assertIn('Async Movie', first[2])
+        self.assertNotIn('Other User Movie', first[2]) #只显示站长的清单
+        self.assertIn('异步站长', first[2])
+        self.assertEqual(first[1][b'x-cache'], b'MISS')
+        self.assertEqual(second[1][b'x-cache'], b'HIT')
+        self.assertIn('异步留言', messages[2])
+        self.assertEqual(not_modified[0], 304)
+        self.assertEqual(bad_cursor[0], 400) #游标错误时由Flask返回错误页面
+        self.assertEqual(login[0], 200)
+        self.assertIn('登录', login[2])
+        self.assertIn('EventSource', messages[2]) #ASGI部署默认开启实时推送
+        self.assertEqual(busy_login[0], 200)
+        self.assertEqual(stream[1][b'content-type'], b'text/event-stream; charset=utf-8')
+        self.assertIn('event: message', stream[2])
+        self.assertIn('异步留言', stream[2])
+        self.assertIn(': ping', stream[2])
+
     #测试更新条目
     def test_update_item(self):
         self.login()
@@ -235,6 +858,53 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertNotIn('登录成功', data)
         self.assertIn('请输入用户名或密码', data)
 
+    #测试登录失败次数限制
+    def test_login_limiter(self):
+        self.app.config['LOGIN_FAILURE_BURST'] = 2
+        for _ in range(2):
+            response = self.client.post('/login', data=dict(username='test', password='wrong'), follow_redirects=True)
+            self.assertIn('用户名或密码错误', response.get_data(as_text=True))
+        #超过次数后即使密码正确也被拒绝
+        response = self.client.post('/login', data=dict(username='test', password='123'), follow_redirects=True)
+        data = response.get_data(as_text=True)
+        self.assertIn('尝试次数过多，请稍后再试', data)
+        self.assertNotIn('登录成功', data)
+
+        #不存在的用户使用dummy密码也不能登录
+        login_limiter.reset()
+        response = self.client.post('/login', data=dict(username='nobody', password='dummy'), follow_redirects=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('用户名或密码错误', response.get_data(as_text=True))
+
+        #登录成功时退还预留的令牌
+        login_limiter.reset()
+        self.app.config['LOGIN_FAILURE_BURST'] = 1
+        for _ in range(3):
+            response = self.client.post('/login', data=dict(username='test', password='123'), follow_redirects=True)
+            self.assertIn('登录成功', response.get_data(as_text=True))
+            self.client.get('/logout')
+
+        #令牌的检查和扣除是原子的，没有令牌的键不会被部分扣除
+        login_limiter.reset()
+        self.assertTrue(login_limiter.consume_all(['a', 'b'], 0, 1))
+        self.assertFalse(login_limiter.consume_all(['a', 'c'], 0, 1))
+        self.assertTrue(login_limiter.consume_all(['c'], 0, 1))
+
+    #测试登录时自动更新hash方法
+    def test_login_rehash(self):
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+        self.login()
+        user = User.query.filter_by(username='test').first()
+        self.assertTrue(user.password_hash.startswith('pbkdf2:sha256:1000$'))
+        self.assertFalse(user.needs_rehash())
+        self.assertTrue(user.validate_password('123'))
+        #省略迭代次数时按Werkzeug的默认值比较，不会每次登录都重新hash
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256'
+        user.set_password('123')
+        self.assertFalse(user.needs_rehash())
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2'
+        self.assertFalse(user.needs_rehash())
+
     #测试登出
     def test_logout(self):
         self.login()
@@ -275,17 +945,196 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertNotIn('设置更新成功', data)
         self.assertIn('输入错误', data)
 
+    #测试站长信息缓存
+    def test_owner_cache(self):
+        self.client.get('/')
+        user = User.query.first()
+        user.name = '未失效'
+        db.session.commit()
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('测试账号的电影清单', data) #缓存未失效时不查询数据库
+        owner_cache.invalidate()
+        page_cache.invalidate()
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('未失效的电影清单', data)
+
+    #测试匿名页面缓存
+    def test_page_cache(self):
+        response = self.client.get('/')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        etag = response.headers['ETag']
+        response = self.client.get('/')
+        self.assertEqual(response.headers['X-Cache'], 'HIT')
+        self.assertIn('Test Movie Title', response.get_data(as_text=True))
+
+        #ETag未变化时返回304
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        #写操作后缓存失效
+        self.login()
+        self.client.post('/', data=dict(title='Cached Movie', year='2001'))
+        self.client.get('/logout', follow_redirects=True)
+        response = self.client.get('/')
+        self.assertIn('Cached Movie', response.get_data(as_text=True))
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    #测试SQLite连接参数
+    def test_sqlite_pragmas(self):
+        self.assertEqual(db.session.execute('PRAGMA busy_timeout').scalar(), self.app.config['SQLITE_BUSY_TIMEOUT'])
+        self.assertEqual(db.session.execute('PRAGMA cache_size').scalar(), self.app.config['SQLITE_CACHE_SIZE'])
+
     #测试虚拟数据
     def test_forge_command(self):
         result = self.runner.invoke(forge)
         self.assertIn('Done.', result.output)
         self.assertNotEqual(Movie.query.count(), 0)
 
+    #测试导入导出命令
+    def test_import_export_commands(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        movies_csv = os.path.join(tmpdir, 'movies.csv')
+        with open(movies_csv, 'w', encoding='utf-8') as f:
+            f.write('title,year\nImported One,1999\nImported Two,2000\n')
+        result = self.runner.invoke(args=['import-movies', movies_csv, '--chunk-size', '1'])
+        self.assertIn('Imported 2 rows.', result.output)
+        self.assertEqual(Movie.query.count(), 3)
+
+        messages_jsonl = os.path.join(tmpdir, 'messages.jsonl')
+        with open(messages_jsonl, 'w', encoding='utf-8') as f:
+            f.write('{"username": "导入", "content": "导入的留言", "ctime": "2020-01-01T08:00:00"}\n')
+        result = self.runner.invoke(args=['import-messages', messages_jsonl])
+        self.assertIn('Imported 1 rows.', result.output)
+        self.assertEqual(MessageBoard.query.first().ctime.year, 2020)
+
+        #历史上重复的留言照常导入，只有第一条有content_hash，与migratedb一致
+        with open(messages_jsonl, 'w', encoding='utf-8') as f:
+            for _ in range(2):
+                f.write('{"username": "导入", "content": "导入的留言", "ctime": "2020-01-02T08:00:00"}\n')
+            f.write('{"username": "导入", "content": "另一条留言", "ctime": "2020-01-03T08:00:00"}\n')
+            f.write('{"username": "导入", "content": "另一条留言", "ctime": "2020-01-04T08:00:00"}\n')
+        result = self.runner.invoke(args=['import-messages', messages_jsonl, '--chunk-size', '3'])
+        self.assertIn('Imported 4 rows.', result.output)
+        self.assertIn('3 rows repeat earlier messages', result.output)
+        self.assertEqual(MessageBoard.query.count(), 5)
+        self.assertEqual(MessageBoard.query.filter(MessageBoard.content_hash.isnot(None)).count(), 2)
+
+        exported = os.path.join(tmpdir, 'export.jsonl')
+        result = self.runner.invoke(args=['export-movies', exported, '--chunk-size', '2'])
+        self.assertEqual(result.exit_code, 0)
+        with open(exported, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertIn('Imported Two', lines[2])
+        self.assertIn('"owner":"test"', lines[2])
+
+        #导入时按owner列找到用户，--user覆盖owner列
+        db.session.add(User(name='Alice', username='alice'))
+        db.session.commit()
+        with open(movies_csv, 'w', encoding='utf-8') as f:
+            f.write('title,year,owner\nAlice One,2001,alice\nNo Owner,2002,\n')
+        result = self.runner.invoke(args=['import-movies', movies_csv])
+        self.assertIn('Imported 2 rows.', result.output)
+        self.assertEqual(Movie.query.filter_by(title='Alice One').first().user.username, 'alice')
+        self.assertEqual(Movie.query.filter_by(title='No Owner').first().user.username, 'test')
+        result = self.runner.invoke(args=['import-movies', movies_csv, '--user', 'test'])
+        self.assertEqual(Movie.query.filter_by(title='Alice One', user_id=1).count(), 1)
+        with open(movies_csv, 'w', encoding='utf-8') as f:
+            f.write('title,year,owner\nLost,2003,nobody\n')
+        result = self.runner.invoke(args=['import-movies', movies_csv])
+        self.assertIn('Unknown owner', result.output)
+
+        #字段不合法时报错
+        with open(movies_csv, 'w', encoding='utf-8') as f:
+            f.write('title,year\nBad Year,19999\n')
+        result = self.runner.invoke(args=['import-movies', movies_csv])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn('Invalid movie row', result.output)
+
+    #测试基准测试的回归判断
+    def test_benchmark_compare(self):
+        from bench_watchlist import compare
+        baseline = {'inprocess': {'index': dict(errors=0, throughput=100.0, p50_ms=2.0, p99_ms=10.0)}}
+        current = {'inprocess': {'index': dict(errors=0, throughput=95.0, p50_ms=2.1, p99_ms=11.0)}}
+        self.assertEqual(compare(current, baseline, 0.25), [])
+        current['inprocess']['index'].update(p50_ms=3.0, errors=1)
+        failures = compare(current, baseline, 0.25)
+        self.assertEqual(len(failures), 2)
+        self.assertIn('p50', failures[1])
+
     #测试初始化数据库
     def test_initdb_command(self):
         result = self.runner.invoke(initdb)
         self.assertIn('Initialized database.', result.output)
 
+    #测试数据库统计命令
+    def test_db_stats_command(self):
+        result = self.runner.invoke(args=['db-stats'])
+        self.assertIn('movie', result.output)
+        self.assertIn('ix_user_username (username): login', result.output)
+        self.assertIn('ix_movie_year (year): unused by route queries', result.output)
+        self.assertIn('Pages:', result.output)
+
+    #测试输出各路由实际执行的查询的执行计划
+    def test_explain_command(self):
+        result = self.runner.invoke(args=['explain'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('index: GET /', result.output)
+        self.assertIn('login: POST /login', result.output)
+        self.assertIn('edit: GET /movie/edit/', result.output)
+        self.assertIn('WHERE user.username = ?', result.output)
+        self.assertNotIn('WHERE message_board.content_hash', result.output) #路由中没有按content_hash的查询
+        self.assertIn('ix_movie_user_id_id', result.output)
+        self.assertIn('No full table scans.', result.output)
+
+    #测试缺少索引时标记全表扫描并以非零状态退出
+    def test_explain_full_scan(self):
+        db.session.execute('DROP INDEX ix_movie_user_id_id')
+        db.session.commit()
+        result = self.runner.invoke(args=['explain'])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('<-- full table scan', result.output)
+        #带WHERE时按索引顺序扫描也无法定位起点
+        from watchlist.diagnostics import is_full_scan
+        statement = 'SELECT * FROM message_board WHERE ctime < ? OR ctime = ? AND id < ? ORDER BY ctime DESC LIMIT ?'
+        self.assertTrue(is_full_scan('SCAN message_board USING INDEX ix_message_board_ctime', statement))
+        self.assertFalse(is_full_scan('SCAN message_board USING INDEX ix_message_board_ctime',
+                                      'SELECT * FROM message_board ORDER BY ctime DESC LIMIT ?'))
+        self.assertFalse(is_full_scan('SEARCH message_board USING INDEX ix_message_board_ctime (ctime<?)', statement))
+
+    #测试升级旧版数据库
+    def test_migratedb_command(self):
+        db.drop_all()
+        #旧版本的表结构：year为字符串，没有索引
+        db.session.execute('CREATE TABLE movie (id INTEGER NOT NULL PRIMARY KEY, title VARCHAR(60), year VARCHAR(4))')
+        db.session.execute("INSERT INTO movie (title, year) VALUES ('Old Movie', '1994')")
+        db.session.execute('CREATE TABLE user (id INTEGER NOT NULL PRIMARY KEY, name VARCHAR(20), '
+                           'username VARCHAR(20), password_hash VARCHAR(128))')
+        db.session.execute("INSERT INTO user (name, username) VALUES ('Old Owner', 'old')")
+        db.session.execute("INSERT INTO user (name, username) VALUES ('Same Name', 'old')")
+        db.session.execute('CREATE INDEX ix_user_username ON user (username)')
+        db.session.commit()
+        result = self.runner.invoke(args=['migratedb'])
+        self.assertIn('Applied movie_year_integer.', result.output)
+        self.assertIn('Applied create_missing_indexes.', result.output)
+        self.assertIn('Applied add_movie_owner.', result.output)
+        self.assertIn('Applied add_updated_at.', result.output)
+        self.assertEqual(Movie.query.first().user.username, 'old') #已有的电影归第一个用户
+        self.assertIn('ix_movie_user_id_id', [index['name'] for index in db.inspect(db.engine).get_indexes('movie')])
+        self.assertEqual(Movie.query.filter(Movie.year > 1990).first().title, 'Old Movie')
+        self.assertIsNotNone(Movie.query.first().updated_at)
+        indexes = db.inspect(db.engine).get_indexes('user')
+        self.assertIn(('ix_user_username', 1), [(index['name'], index['unique']) for index in indexes])
+        #重名的用户改名，id最小的保留原用户名
+        self.assertIn('Applied unique_username.', result.output)
+        self.assertEqual([user.username for user in User.query.order_by(User.id)], ['old', 'old_2'])
+
+        #再次执行时没有需要升级的内容
+        result = self.runner.invoke(args=['migratedb'])
+        self.assertNotIn('Applied', result.output)
+        self.assertIn('Database is up to date.', result.output)
+
     #测试生成管理员账户
     def test_admin_command(self):
         db.drop_all()
@@ -307,5 +1156,14 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertEqual(User.query.first().username, 'superman')
         self.assertTrue(User.query.first().validate_password('456'))
 
+        #不能改成其他用户的用户名，更新的是首页显示的站长
+        self.runner.invoke(args=['add-user', '--username', 'alice', '--name', 'Alice', '--password', '789'])
+        result = self.runner.invoke(args=['admin', '--username', 'alice', '--password', '456'])
+        self.assertIn('Username alice already exists.', result.output)
+        self.assertEqual(User.query.filter_by(username='alice').count(), 1)
+        result = self.runner.invoke(args=['admin', '--username', 'superman', '--password', '000'])
+        self.assertEqual(User.query.order_by(User.id).first().username, 'superman')
+        self.assertTrue(User.query.order_by(User.id).first().validate_password('000'))
+
 if __name__ == '__main__':
     unittest.main()
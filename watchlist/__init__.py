@@ -1,23 +1,15 @@
-import os
-import sys
-from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
-from flask_login import LoginManager
+import threading
+from flask import Flask, has_request_context
+from flask_login import LoginManager, current_user
+from watchlist.database import TunedSQLAlchemy
+from watchlist.writer import MessageWriter
 
 
-WIN = sys.platform.startswith('win')
-if WIN:
-    prefix = 'sqlite:///'
-else:
-    prefix = 'sqlite:////'
-
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'CallMeBigYe')
-app.config['SQLALCHEMY_DATABASE_URI'] = prefix + os.path.join(os.path.dirname(app.root_path), os.getenv('DATABASE_FILE', 'data.db'))
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-db = SQLAlchemy(app)
-login_manager = LoginManager(app)
+#扩展在导入时只创建对象，由create_app绑定到应用上；命令在create_app中导入，
+#视图和请求钩子等到第一个请求才导入，flask forge等命令不加载这些模块
+db = TunedSQLAlchemy()
+login_manager = LoginManager()
+message_writer = MessageWriter()
 
 @login_manager.user_loader
 def load_user(user_id): #创建用户加载回调函数，接收用户ID作为参数
@@ -25,12 +17,66 @@ def load_user(user_id): #创建用户加载回调函数，接收用户ID作为
     user = User.query.get(int(user_id)) #用ID作为User模型的主键查询对应的用户
     return user #返回用户对象
 
-login_manager.login_view = 'login'
+login_manager.login_view = 'main.login'
 
-@app.context_processor
 def inject_user():
-    from watchlist.models import User
-    user = User.query.first()
+    from watchlist.cache import Owner, get_owner
+    if has_request_context() and current_user.is_authenticated: #登录后的页面标题显示自己的名字
+        return dict(user = Owner(current_user.id, current_user.name, current_user.username))
+    user = get_owner() #从进程内缓存读取，不再每次渲染都查询数据库
     return dict(user = user)
 
-from watchlist import routes, errors, commands
\ No newline at end of file
+def create_app(config=None):
+    """创建应用，config为覆盖默认配置的字典。flask命令会自动调用这个工厂函数。"""
+    app = Flask(__name__)
+    app.config.from_object('watchlist.settings')
+    if config:
+        app.config.update(config)
+
+    from watchlist.cache import init_caches
+    from watchlist.stream import init_stream
+    db.init_app(app)
+    login_manager.init_app(app)
+    message_writer.init_app(app)
+    init_caches(app) #进程内的缓存和推送状态都保存在app.extensions中，每个应用各自一份
+    init_stream(app)
+    app.context_processor(inject_user)
+
+    import watchlist.search #注册事件，flask initdb等命令执行create_all时同时创建全文索引表
+    from watchlist.commands import commands
+    app.register_blueprint(commands)
+    app.wsgi_app = LazyViews(app, app.wsgi_app)
+    return app
+
+def init_views(app):
+    """注册视图、请求钩子和模板设置，重复调用时不做任何事。需要在请求之外使用url_for时先调用。"""
+    if app.extensions.get('views'):
+        return
+    from watchlist.metrics import init_metrics
+    from watchlist.templating import init_templates
+    from watchlist.assets import init_assets
+    from watchlist.compress import init_compression
+    from watchlist.routes import main
+    from watchlist.api import api
+    from watchlist.errors import errors
+    init_metrics(app)
+    init_templates(app)
+    init_assets(app)
+    init_compression(app)
+    app.register_blueprint(main)
+    app.register_blueprint(api, url_prefix='/api')
+    app.register_blueprint(errors)
+    app.extensions['views'] = True
+
+
+class LazyViews(object): #WSGI中间件，第一个请求到来时调用init_views，在Flask处理请求之前完成注册
+    def __init__(self, app, wsgi_app):
+        self.app = app
+        self.wsgi_app = wsgi_app
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        if not self.app.extensions.get('views'):
+            with self._lock: #多线程服务器上只注册一次
+                init_views(self.app)
+        return self.wsgi_app(environ, start_response)
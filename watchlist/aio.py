@@ -0,0 +1,281 @@
+import asyncio
+import sqlite3
+from datetime import datetime
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+import aiosqlite
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from flask import render_template
+from sqlalchemy.engine.url import make_url
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_accept_header, parse_etags
+from watchlist import db, init_views, message_writer
+from watchlist.archive import list_segments
+from watchlist.cache import Owner
+from watchlist.compress import choose_encoding, cached_compress
+from watchlist.database import is_sqlite_file, sqlite_pragmas, compile_query
+from watchlist.models import User, Movie, MessageBoard
+from watchlist.pagination import keyset_clauses, build_page
+from watchlist.stream import messages_query, event_row, fetch_messages, format_event
+
+
+#ASGI入口：未登录用户对首页和留言板的GET请求用aiosqlite异步查询，不占用线程，
+#其他请求（写操作、登录后的页面、静态文件等）交给线程池中的WSGI应用处理；
+#留言实时推送的每个连接只是一个等待唤醒的协程，不占用线程池
+STREAM_PATH = '/messageboard/stream'
+
+
+def _to_row(row, table):
+    values = {}
+    for key in row.keys():
+        value = row[key]
+        if value is not None and isinstance(table.c[key].type, db.DateTime):
+            value = datetime.fromisoformat(value)
+        values[key] = value
+    return SimpleNamespace(**values)
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+async def _wait_disconnect(receive, wakeup):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+    wakeup.set()
+
+
+class _ThreadedInstance(WsgiToAsgiInstance):
+    #asgiref默认在同一个线程中依次执行同步代码，改为在线程池中并发执行WSGI请求
+    run_wsgi_app = sync_to_async(WsgiToAsgiInstance.__dict__['run_wsgi_app'].func, thread_sensitive=False)
+
+
+class ThreadedWsgiToAsgi(WsgiToAsgi):
+    async def __call__(self, scope, receive, send):
+        await _ThreadedInstance(self.wsgi_application, self.duplicate_header_limit)(scope, receive, send)
+
+
+class ConnectionPool(object): #固定数量的aiosqlite连接，每个连接有自己的后台线程
+    def __init__(self, path, size, pragmas):
+        self.path = path
+        self.size = size
+        self.pragmas = pragmas
+        self._queue = None
+
+    async def open(self):
+        if self._queue is not None:
+            return
+        queue = asyncio.Queue()
+        for _ in range(self.size):
+            conn = await aiosqlite.connect(self.path)
+            conn.row_factory = sqlite3.Row
+            for name, value in self.pragmas:
+                await conn.execute('PRAGMA %s = %s' % (name, value))
+            queue.put_nowait(conn)
+        self._queue = queue
+
+    async def close(self):
+        queue, self._queue = self._queue, None
+        if queue is None:
+            return
+        while not queue.empty():
+            await queue.get_nowait().close()
+
+    async def fetchall(self, query) -> list:
+        await self.open()
+        conn = await self._queue.get()
+        try:
+            sql, params = compile_query(query)
+            async with conn.execute(sql, params) as cursor:
+                return await cursor.fetchall()
+        finally:
+            self._queue.put_nowait(conn)
+
+
+class AsyncApp(object):
+    def __init__(self, app):
+        init_views(app) #原生处理的页面不经过WSGI，需要提前注册视图才能渲染模板
+        self.app = app
+        #协程中没有应用上下文，直接使用本应用的缓存、推送和留言队列
+        self.page_cache = app.extensions['page_cache']
+        self.owner_cache = app.extensions['owner_cache']
+        self.broker = app.extensions['message_broker']
+        self.wsgi = ThreadedWsgiToAsgi(app)
+        self.pool = None
+        sa_url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+        if is_sqlite_file(sa_url): #其他数据库没有可用的异步驱动，全部走WSGI
+            #SQLite的journal_mode是数据库级别的设置，已由同步连接设置
+            pragmas = [pragma for pragma in sqlite_pragmas(app.config) if pragma[0] != 'journal_mode']
+            self.pool = ConnectionPool(sa_url.database, app.config['ASGI_DB_POOL_SIZE'], pragmas)
+        self.views = {'/': ('main.index', self.index), '/messageboard': ('main.messageboard', self.messageboard)}
+        if app.config['SSE_ENABLED'] is None: #没有明确配置时，ASGI部署默认开启实时推送
+            app.config['SSE_ENABLED'] = True
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] == 'http' and scope.get('path') == STREAM_PATH and scope['method'] == 'GET':
+            return await self.stream(scope, receive, send)
+        view = self.views.get(scope.get('path')) if scope['type'] == 'http' else None
+        if view is not None and self._can_serve(scope):
+            try:
+                return await self.serve(view, scope, send)
+            except HTTPException: #例如游标格式错误，由Flask生成错误页面
+                pass
+        return await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                if self.pool is not None:
+                    await self.pool.open()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.pool is not None:
+                    await self.pool.close()
+                await asyncio.get_running_loop().run_in_executor(None, message_writer.queue(self.app).flush)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _can_serve(self, scope) -> bool:
+        #带Cookie的请求可能已登录或有闪现消息，与cached_page的判断保持一致
+        if self.pool is None or scope['method'] not in ('GET', 'HEAD') or self.app.config['PAGE_CACHE_TTL'] <= 0:
+            return False
+        return not any(name == b'cookie' for name, value in scope['headers'])
+
+    async def serve(self, view, scope, send):
+        endpoint, render = view
+        query_string = scope['query_string'].decode('utf-8', 'replace')
+        args = dict((key, values[0]) for key, values in parse_qs(query_string).items())
+        key = (endpoint, scope['path'] + '?' + query_string) #与request.full_path相同
+        entry = self.page_cache.get(key)
+        if entry is not None:
+            cache_status = b'HIT'
+        else:
+            if not self.owner_cache.is_fresh():
+                await self._load_owner()
+            template, context = await render(args)
+            with self.app.test_request_context(scope['path'], query_string=query_string):
+                body = render_template(template, **context).encode('utf-8') #渲染期间不能await，请求上下文不跨协程共享
+            entry = self.page_cache.set(key, body, self.app.config['PAGE_CACHE_TTL'], self.app.config['PAGE_CACHE_SIZE'])
+            cache_status = b'MISS'
+        body, etag = entry.body, entry.etag
+        request_headers = dict(scope['headers'])
+        config = self.app.config
+        encoding, level = choose_encoding(parse_accept_header(request_headers.get(b'accept-encoding', b'').decode('latin-1')), config)
+        if not config['COMPRESS_ENABLED'] or len(body) < config['COMPRESS_MIN_SIZE']:
+            encoding = None
+        #与compress_response一致，压缩后的响应使用弱ETag
+        headers = [(b'etag', ('%s"%s"' % ('W/' if encoding else '', etag)).encode('ascii')),
+                   (b'vary', b'Cookie, Accept-Encoding'), (b'x-cache', cache_status)]
+        if b'if-none-match' in request_headers and \
+                parse_etags(request_headers[b'if-none-match'].decode('latin-1')).contains_weak(etag):
+            await send({'type': 'http.response.start', 'status': 304, 'headers': headers})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        if encoding is not None:
+            body = cached_compress(entry.variants, body, encoding, level)
+            headers.append((b'content-encoding', encoding.encode('ascii')))
+        headers += [(b'content-type', b'text/html; charset=utf-8'), (b'content-length', str(len(body)).encode('ascii'))]
+        await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body if scope['method'] == 'GET' else b''})
+
+    async def stream(self, scope, receive, send):
+        """与main.message_stream相同的SSE事件，等待新留言时由查询线程唤醒。"""
+        config = self.app.config
+        loop = asyncio.get_running_loop()
+        args = dict((key, values[0]) for key, values in parse_qs(scope['query_string'].decode('latin-1')).items())
+        since = _to_int(dict(scope['headers']).get(b'last-event-id', b'').decode('latin-1'))
+        if since is None:
+            since = _to_int(args.get('last_id', ''))
+        latest = await loop.run_in_executor(None, self.broker.subscribe) #第一次订阅时查询数据库
+        if since is None:
+            since = latest
+        wakeup = asyncio.Event()
+        listener = lambda: loop.call_soon_threadsafe(wakeup.set)
+        self.broker.add_listener(listener)
+        disconnected = loop.create_task(_wait_disconnect(receive, wakeup))
+        try:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'), (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no')]})
+            await send({'type': 'http.response.body', 'body': b'retry: %d\n\n' % config['SSE_RETRY_MS'],
+                        'more_body': True})
+            deadline = loop.time() + config['SSE_STREAM_TIMEOUT']
+            while not disconnected.done():
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                wakeup.clear() #先清除再读取缓冲区，之后发布的留言一定会唤醒
+                rows = self.broker.poll(since)
+                if rows is None: #落后太多，直接从数据库补齐
+                    rows = await self._fetch_messages(since)
+                if rows:
+                    chunk = ''.join(format_event(row) for row in rows)
+                    since = rows[-1]['id']
+                else:
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), min(config['SSE_HEARTBEAT'], remaining))
+                        continue
+                    except asyncio.TimeoutError:
+                        chunk = ': ping\n\n' #心跳，及时发现已断开的连接
+                await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+            if not disconnected.done():
+                await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            self.broker.remove_listener(listener)
+            disconnected.cancel()
+
+    async def _fetch_messages(self, since) -> list:
+        limit = self.app.config['SSE_BUFFER_SIZE']
+        if self.pool is None:
+            return await asyncio.get_running_loop().run_in_executor(None, self._fetch_messages_sync, since, limit)
+        rows = await self.pool.fetchall(messages_query(since, limit))
+        return [event_row(_to_row(row, MessageBoard.__table__)) for row in rows]
+
+    def _fetch_messages_sync(self, since, limit) -> list:
+        with self.app.app_context():
+            try:
+                return fetch_messages(since, limit)
+            finally:
+                db.session.remove()
+
+    async def _load_owner(self):
+        table = User.__table__
+        rows = await self.pool.fetchall(db.select([table.c.id, table.c.name, table.c.username]).order_by(table.c.id).limit(1))
+        owner = Owner(rows[0]['id'], rows[0]['name'], rows[0]['username']) if rows else None
+        self.owner_cache.prime(owner, self.app.config['OWNER_CACHE_TTL'])
+
+    async def _paginate(self, model, columns, per_page, args, descending=False, where=None):
+        table = model.__table__
+        criterion, order, backward, cursor = keyset_clauses(columns, args.get('after'), args.get('before'), descending)
+        query = db.select([table]).order_by(*order).limit(per_page + 1)
+        count = db.select([db.func.count()]).select_from(table)
+        if where is not None:
+            query, count = query.where(where), count.where(where)
+        if criterion is not None:
+            query = query.where(criterion)
+        rows = await self.pool.fetchall(query)
+        total = await self.pool.fetchall(count)
+        return build_page([_to_row(row, table) for row in rows], columns, per_page, backward, cursor, total[0][0])
+
+    async def index(self, args):
+        #未登录时显示站长的清单，站长信息在serve中已经写入缓存
+        owner = self.owner_cache.get(self.app.config['OWNER_CACHE_TTL'])
+        owner_id = owner.id if owner is not None else None
+        pagination = await self._paginate(Movie, [Movie.id], self.app.config['MOVIES_PER_PAGE'], args,
+                                          where=Movie.__table__.c.user_id == owner_id)
+        return 'index.html', dict(movies=pagination.items, pagination=pagination, user=owner, editable=False)
+
+    async def messageboard(self, args):
+        #最新的留言显示在最前面
+        pagination = await self._paginate(MessageBoard, [MessageBoard.ctime, MessageBoard.id],
+                                          self.app.config['MESSAGES_PER_PAGE'], args, descending=True)
+        latest_id = max([message.id for message in pagination.items] or [0])
+        archived = not pagination.has_next and bool(list_segments(self.app.config['ARCHIVE_DIR']))
+        return 'messages.html', dict(messageboard=pagination.items, pagination=pagination, latest_id=latest_id,
+                                     archived=archived)
@@ -0,0 +1,98 @@
+import hashlib
+import json
+from flask import Blueprint, current_app, request, abort
+from watchlist import db
+from watchlist.models import User, Movie, MessageBoard
+from watchlist.cache import get_owner
+from watchlist.pagination import keyset_clauses, build_page
+
+
+#只读JSON接口，供仪表盘轮询使用
+api = Blueprint('api', __name__)
+
+API_FIELDS = {
+    'movies': ['id', 'title', 'year'],
+    'messages': ['id', 'username', 'content', 'ctime'],
+}
+
+
+def _select_fields(kind) -> list:
+    fields = request.args.get('fields')
+    if not fields:
+        return API_FIELDS[kind]
+    fields = [field for field in fields.split(',') if field]
+    if not fields or any(field not in API_FIELDS[kind] for field in fields):
+        abort(400)
+    return fields
+
+def _limit() -> int:
+    limit = request.args.get('limit', current_app.config['API_PER_PAGE'], type=int)
+    return max(1, min(limit, current_app.config['API_MAX_PER_PAGE']))
+
+def _dump(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+def _json_response(payload, etag, last_modified=None):
+    body = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    response = current_app.response_class(body, mimetype='application/json') #由compress统一压缩
+    return _with_validators(response, etag, last_modified)
+
+def _with_validators(response, etag, last_modified=None):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True #每次都要重新验证
+    return response
+
+def _etag(*state) -> str:
+    #数据状态加上查询参数共同决定结果，参数不同的请求ETag也不同
+    key = repr(state + (request.full_path,)).encode('utf-8')
+    return hashlib.sha1(key).hexdigest()
+
+def _not_modified(etag, last_modified=None):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag) #压缩后的响应使用弱ETag
+    if last_modified is not None and request.if_modified_since is not None:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since.replace(tzinfo=None)
+    return False
+
+def _movie_owner_id():
+    #?user=用户名 指定清单，默认为站长的清单
+    username = request.args.get('user')
+    if username is None:
+        owner = get_owner()
+        return owner.id if owner is not None else None
+    return User.query.filter_by(username=username).first_or_404().id
+
+def _list(kind, model, columns, descending, etag, last_modified, total, query=None):
+    #先检查参数，参数错误时即使数据未变化也返回400
+    fields = _select_fields(kind)
+    criterion, order, backward, cursor = keyset_clauses(columns, request.args.get('after'), request.args.get('before'), descending)
+    #再用聚合查询判断数据是否变化，未变化时直接返回304，不查询也不序列化数据
+    if _not_modified(etag, last_modified):
+        return _with_validators(current_app.response_class(status=304), etag, last_modified)
+    query = query if query is not None else model.query
+    if criterion is not None:
+        query = query.filter(criterion)
+    per_page = _limit()
+    pagination = build_page(query.order_by(*order).limit(per_page + 1).all(), columns, per_page, backward, cursor, total)
+    items = [dict((field, _dump(getattr(row, field))) for field in fields) for row in pagination.items]
+    payload = dict(items=items, total=pagination.total,
+                   next=pagination.next_cursor, prev=pagination.prev_cursor)
+    return _json_response(payload, etag, last_modified)
+
+@api.route('/movies')
+def movies():
+    #编辑电影不改变max(id)和count，需要加上max(updated_at)
+    owner_id = _movie_owner_id()
+    max_id, max_updated, total = db.session.query(
+        db.func.max(Movie.id), db.func.max(Movie.updated_at), db.func.count(Movie.id)).filter(Movie.user_id == owner_id).one()
+    return _list('movies', Movie, [Movie.id], False, _etag(max_id, max_updated, total), max_updated, total,
+                 query=Movie.query.filter_by(user_id=owner_id))
+
+@api.route('/messages')
+def messages():
+    max_id, max_ctime, total = db.session.query(
+        db.func.max(MessageBoard.id), db.func.max(MessageBoard.ctime), db.func.count(MessageBoard.id)).one()
+    return _list('messages', MessageBoard, [MessageBoard.ctime, MessageBoard.id], True,
+                 _etag(max_id, max_ctime, total), max_ctime, total)
@@ -0,0 +1,181 @@
+import gzip
+import json
+import os
+import re
+from datetime import datetime
+from types import SimpleNamespace
+from watchlist import db
+from watchlist.lru import LRUCache
+from watchlist.models import MessageBoard
+
+
+#旧留言按(ctime, id)从旧到新分批写入只追加的gzip JSON Lines分段，然后从数据库删除，
+#每批一个分段文件，文件写完并改名之后才删除数据库中的行；
+#每个分段的行数和起止时间记在index.json中，显示归档列表不需要解压任何分段
+SEGMENT_PATTERN = re.compile(r'^messages-(\d{6})\.jsonl\.gz$')
+INDEX_FILE = 'index.json'
+FIELDS = ['id', 'username', 'content', 'ctime', 'updated_at']
+
+
+def segment_name(seq) -> str:
+    return 'messages-%06d.jsonl.gz' % seq
+
+def list_segments(directory) -> list:
+    """返回按序号排列的分段序号。"""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(int(match.group(1)) for match in map(SEGMENT_PATTERN.match, os.listdir(directory)) if match)
+
+def _replace(path, write):
+    #先写临时文件并同步到磁盘，再改名替换，读取的进程不会看到写了一半的文件
+    tmp_path = path + '.tmp'
+    write(tmp_path)
+    with open(tmp_path, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def _write_segment(directory, seq, rows):
+    os.makedirs(directory, exist_ok=True)
+    def write(tmp_path):
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            for row in rows:
+                f.write(json.dumps(dict((field, _dump(row[field])) for field in FIELDS), ensure_ascii=False) + '\n')
+    _replace(os.path.join(directory, segment_name(seq)), write) #写入磁盘之后才删除数据库中的行
+
+def _dump(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def _read_segment(path) -> list:
+    rows = []
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            row = json.loads(line)
+            for field in ('ctime', 'updated_at'):
+                if row.get(field):
+                    row[field] = datetime.fromisoformat(row[field])
+            rows.append(SimpleNamespace(**row))
+    return rows
+
+
+def _summarize(rows):
+    def ctime(row):
+        return row['ctime'] if isinstance(row, dict) else row.ctime
+    return (len(rows), ctime(rows[0]), ctime(rows[-1])) if rows else (0, None, None)
+
+def read_index(directory) -> dict:
+    """返回{分段序号: (行数, 最早留言时间, 最晚留言时间)}，文件修改时间不变时使用缓存。"""
+    path = os.path.join(directory, INDEX_FILE)
+    if not os.path.exists(path):
+        return {}
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size) #同一时刻连续写入时大小也会变化
+    index = index_cache.get(key)
+    if index is None:
+        with open(path, encoding='utf-8') as f:
+            index = dict((int(seq), (count, _load_time(first), _load_time(last)))
+                         for seq, (count, first, last) in json.load(f).items())
+        index_cache.set(key, index)
+    return index
+
+def _write_index(directory, index):
+    data = dict((str(seq), [count, _dump(first), _dump(last)]) for seq, (count, first, last) in sorted(index.items()))
+    def write(tmp_path):
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+    _replace(os.path.join(directory, INDEX_FILE), write)
+
+def _load_time(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+segment_cache = LRUCache(8) #解压后的分段按LRU缓存，文件修改时间变化时重新读取
+index_cache = LRUCache(8)
+
+def load_segment(directory, seq) -> list:
+    """分段中的留言，按(ctime, id)从旧到新排列。"""
+    path = os.path.join(directory, segment_name(seq))
+    key = (path, os.stat(path).st_mtime)
+    rows = segment_cache.get(key)
+    if rows is None:
+        rows = _read_segment(path)
+        segment_cache.set(key, rows)
+    return rows
+
+def segment_summary(directory, seq):
+    """返回(行数, 最早留言时间, 最晚留言时间)，不在index.json中的旧分段需要解压统计。"""
+    summary = read_index(directory).get(seq)
+    return summary if summary is not None else _summarize(load_segment(directory, seq))
+
+
+def _delete_archived(conn, ids) -> int:
+    table = MessageBoard.__table__
+    deleted = 0
+    for start in range(0, len(ids), 500): #SQLite限制单条语句的参数个数
+        deleted += conn.execute(table.delete().where(table.c.id.in_(ids[start:start + 500]))).rowcount
+    return deleted
+
+def _resume(conn, rows) -> int:
+    #删除全部留言后SQLite可能复用id，只删除内容完全相同的行
+    table = MessageBoard.__table__
+    archived = dict((row.id, (row.username, row.content, row.ctime)) for row in rows)
+    ids = list(archived)
+    duplicates = []
+    for start in range(0, len(ids), 500):
+        query = db.select([table.c.id, table.c.username, table.c.content, table.c.ctime]) \
+            .where(table.c.id.in_(ids[start:start + 500]))
+        duplicates.extend(row.id for row in conn.execute(query)
+                          if archived[row.id] == (row.username, row.content, row.ctime))
+    return _delete_archived(conn, duplicates)
+
+def archive_messages(cutoff, directory, batch_size=1000) -> int:
+    """把ctime早于cutoff的留言移入归档，返回归档的行数。"""
+    table = MessageBoard.__table__
+    segments = list_segments(directory)
+    index = dict(read_index(directory))
+    if segments:
+        #上次在写完分段之后、删除之前中断时，分段中的行还在数据库中
+        with db.engine.begin() as conn:
+            _resume(conn, load_segment(directory, segments[-1]))
+        missing = [seq for seq in segments if seq not in index] #之前的版本或中断时没有写入index.json
+        if missing:
+            for seq in missing:
+                index[seq] = _summarize(load_segment(directory, seq))
+            _write_index(directory, index)
+    seq = segments[-1] if segments else 0
+    archived = 0
+    while True:
+        query = db.select([table.c[field] for field in FIELDS]).where(table.c.ctime < cutoff) \
+            .order_by(table.c.ctime, table.c.id).limit(batch_size) #走ctime索引
+        rows = [dict(row) for row in db.engine.execute(query)]
+        if not rows:
+            return archived
+        seq += 1
+        _write_segment(directory, seq, rows)
+        index[seq] = _summarize(rows)
+        _write_index(directory, index)
+        with db.engine.begin() as conn: #一批只提交一次事务
+            _delete_archived(conn, [row['id'] for row in rows])
+        archived += len(rows)
+
+def compact(incremental=False) -> str:
+    """归档后回收数据库文件的空闲页，返回执行的操作。"""
+    if db.engine.dialect.name != 'sqlite':
+        return 'skipped'
+    with db.engine.connect() as conn:
+        mode = conn.execute('PRAGMA auto_vacuum').scalar()
+        if mode == 2: #INCREMENTAL模式只需要释放空闲页，不用重写整个文件
+            #sqlite3模块每次execute只执行一步，每步释放一个空闲页，在一个事务中循环执行
+            pages = conn.execute('PRAGMA freelist_count').scalar()
+            conn.execute('BEGIN')
+            for _ in range(pages):
+                conn.execute('PRAGMA incremental_vacuum(1)')
+            conn.execute('COMMIT')
+            action = 'incremental_vacuum'
+        else:
+            if incremental: #切换模式需要执行一次完整的VACUUM，之后归档只需incremental_vacuum
+                conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+            action = 'vacuum'
+        if conn.execute('PRAGMA journal_mode').scalar() == 'wal':
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall() #WAL文件也缩小
+    return action
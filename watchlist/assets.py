@@ -0,0 +1,138 @@
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import shutil
+import subprocess
+import tempfile
+from flask import current_app, request, send_from_directory
+from werkzeug.security import safe_join
+
+
+#静态文件构建：复制为带内容哈希的文件名，内容变化时URL随之变化，浏览器可以永久缓存
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt') #图片本身已压缩，不再生成.gz/.br
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')] #按优先级排列
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+def _source_files(static_folder):
+    for root, dirs, files in os.walk(static_folder):
+        if root == static_folder and DIST_DIR in dirs:
+            dirs.remove(DIST_DIR)
+        for name in sorted(files):
+            yield os.path.relpath(os.path.join(root, name), static_folder).replace(os.sep, '/')
+
+def _write(dist, name, data):
+    path = os.path.join(dist, *name.split('/'))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path) #正在运行的进程不会读到写了一半的文件
+
+def hashed_name(name, data) -> str:
+    base, ext = os.path.splitext(name)
+    return '%s.%s%s' % (base, hashlib.sha256(data).hexdigest()[:12], ext)
+
+def compress_variants(data) -> dict:
+    """返回{后缀: 压缩后的数据}，没有安装brotli时只生成.gz，压缩后没有变小的不保留。"""
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0) as f: #mtime固定，重复构建结果相同
+        f.write(data)
+    variants = {'.gz': buffer.getvalue()}
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+    if brotli is not None:
+        variants['.br'] = brotli.compress(data, quality=11)
+    return dict((suffix, value) for suffix, value in variants.items() if len(value) < len(data))
+
+def convert_gif(path) -> dict:
+    """把动图转换为体积更小的格式，返回{扩展名: 数据}，缺少Pillow或ffmpeg时跳过对应格式。"""
+    variants = {}
+    try:
+        from PIL import Image
+    except ImportError:
+        Image = None
+    if Image is not None:
+        buffer = io.BytesIO()
+        with Image.open(path) as image:
+            image.save(buffer, 'WEBP', save_all=True, quality=80, method=6)
+        variants['.webp'] = buffer.getvalue()
+    if shutil.which('ffmpeg'):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output = os.path.join(tmpdir, 'output.mp4')
+            #H.264要求宽高为偶数
+            subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-i', path, '-movflags', 'faststart',
+                            '-pix_fmt', 'yuv420p', '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2', output], check=True)
+            with open(output, 'rb') as f:
+                variants['.mp4'] = f.read()
+    return variants
+
+def build_assets(static_folder) -> dict:
+    """在static/dist中生成新的带哈希文件，返回原文件名到dist中文件名的映射，同时写入dist/manifest.json。"""
+    #不删除以前构建的文件，已缓存旧页面的浏览器和还没重启的进程仍能加载旧地址
+    dist = os.path.join(static_folder, DIST_DIR)
+    manifest = {}
+    for name in list(_source_files(static_folder)):
+        path = os.path.join(static_folder, *name.split('/'))
+        with open(path, 'rb') as f:
+            outputs = {name: f.read()}
+        if name.endswith('.gif'):
+            base = os.path.splitext(name)[0]
+            for ext, data in convert_gif(path).items():
+                outputs[base + ext] = data
+        for source, data in outputs.items():
+            target = hashed_name(source, data)
+            manifest[source] = DIST_DIR + '/' + target
+            if os.path.exists(os.path.join(dist, *target.split('/'))): #内容没有变化
+                continue
+            _write(dist, target, data)
+            if source.endswith(COMPRESSIBLE):
+                for suffix, compressed in compress_variants(data).items():
+                    _write(dist, target + suffix, compressed)
+    _write(dist, MANIFEST, json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    return manifest
+
+def load_manifest(static_folder) -> dict:
+    path = os.path.join(static_folder, DIST_DIR, MANIFEST)
+    if not os.path.exists(path): #没有执行过flask build-assets时使用原文件
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def send_static(filename):
+    """替换Flask默认的static视图，dist中的文件优先返回预压缩版本并允许永久缓存。"""
+    app = current_app
+    if not filename.startswith(DIST_DIR + '/'):
+        return app.send_static_file(filename)
+    response = None
+    for encoding, suffix in ENCODINGS:
+        path = safe_join(app.static_folder, filename + suffix)
+        if encoding in request.accept_encodings and path is not None and os.path.isfile(path):
+            response = send_from_directory(app.static_folder, filename + suffix,
+                                           mimetype=mimetypes.guess_type(filename)[0])
+            response.headers['Content-Encoding'] = encoding
+            break
+    if response is None:
+        response = app.send_static_file(filename)
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = IMMUTABLE #文件名包含内容哈希，内容不会变化
+    return response
+
+def init_assets(app):
+    app.extensions['assets'] = load_manifest(app.static_folder) if app.config['ASSET_FINGERPRINT'] else {}
+
+    @app.url_defaults
+    def fingerprint_static(endpoint, values):
+        #url_for('static', filename='style.css')自动生成带哈希的地址
+        if endpoint == 'static' and 'filename' in values:
+            values['filename'] = app.extensions['assets'].get(values['filename'], values['filename'])
+
+    app.view_functions['static'] = send_static
+    app.jinja_env.globals['has_asset'] = lambda filename: filename in app.extensions['assets']
@@ -0,0 +1,122 @@
+import hashlib
+import threading
+import time
+from collections import namedtuple
+from functools import wraps
+from flask import current_app, g, request, session, make_response
+from flask_login import current_user
+from werkzeug.local import LocalProxy
+from watchlist.lru import LRUCache
+
+
+#站长信息的只读快照，不持有数据库会话，可以在请求之间安全共享
+Owner = namedtuple('Owner', ['id', 'name', 'username'])
+#缓存的页面，variants为{编码: 压缩后的内容}，每种编码只在第一次命中时压缩一次
+CachedPage = namedtuple('CachedPage', ['body', 'etag', 'expires', 'variants'])
+
+_MISSING = object()
+
+
+class OwnerCache(object): #进程内缓存站长信息，避免每次渲染模板都查询数据库
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._owner = _MISSING
+        self._expires = 0.0
+
+    def get(self, ttl):
+        owner, expires = self._owner, self._expires
+        if owner is not _MISSING and time.monotonic() < expires:
+            return owner
+        with self._lock:
+            if self._owner is _MISSING or time.monotonic() >= self._expires:
+                self._owner = self._load()
+                #多进程部署时其他进程无法通知本进程失效，用TTL限制数据过期的时间
+                self._expires = time.monotonic() + ttl
+            return self._owner
+
+    def invalidate(self):
+        with self._lock:
+            self._owner = _MISSING
+            self._expires = 0.0
+
+    def is_fresh(self) -> bool:
+        return self._owner is not _MISSING and time.monotonic() < self._expires
+
+    def prime(self, owner, ttl):
+        #由其他途径（如异步数据库连接）查询到站长信息后直接写入缓存
+        with self._lock:
+            self._owner = owner
+            self._expires = time.monotonic() + ttl
+
+    @staticmethod
+    def _load():
+        from watchlist.models import User
+        user = User.query.order_by(User.id).first() #站长是id最小的用户
+        if user is None:
+            return None
+        return Owner(user.id, user.name, user.username)
+
+
+owner_cache = LocalProxy(lambda: current_app.extensions['owner_cache']) #当前应用的缓存
+
+def get_owner():
+    return owner_cache.get(current_app.config['OWNER_CACHE_TTL'])
+
+
+class PageCache(object): #匿名GET请求的整页缓存，按LRU淘汰
+    def __init__(self):
+        self._entries = LRUCache()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() >= entry.expires:
+            self._entries.pop(key)
+            return None
+        return entry
+
+    def set(self, key, body, ttl, max_size) -> CachedPage:
+        entry = CachedPage(body, hashlib.sha1(body).hexdigest(), time.monotonic() + ttl, {})
+        self._entries.set(key, entry, max_size)
+        return entry
+
+    def invalidate(self, endpoint=None):
+        #endpoint为None时清空全部页面，否则只清除该视图的页面
+        if endpoint is None:
+            self._entries.clear()
+        else:
+            self._entries.remove_if(lambda key: key[0] == endpoint)
+
+
+page_cache = LocalProxy(lambda: current_app.extensions['page_cache'])
+
+def init_caches(app):
+    #缓存属于各自的应用，同一进程中创建多个应用时互不影响
+    app.extensions['owner_cache'] = OwnerCache()
+    app.extensions['page_cache'] = PageCache()
+
+def cached_page(view):
+    """缓存未登录用户对该视图的GET请求，写操作需调用page_cache.invalidate()。"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        ttl = current_app.config['PAGE_CACHE_TTL']
+        #闪现消息属于单个会话，有待显示的消息时不能使用也不能写入缓存
+        if (ttl <= 0 or request.method not in ('GET', 'HEAD')
+                or current_user.is_authenticated or session.get('_flashes')):
+            return view(*args, **kwargs)
+        key = (request.endpoint, request.full_path)
+        g.page_cacheable = True #要写入缓存的页面不使用流式渲染
+        entry = page_cache.get(key)
+        if entry is not None:
+            response = current_app.response_class(entry.body, mimetype='text/html')
+            response.headers['X-Cache'] = 'HIT'
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200 or session.get('_flashes'):
+                return response
+            entry = page_cache.set(key, response.get_data(), ttl, current_app.config['PAGE_CACHE_SIZE'])
+            response.headers['X-Cache'] = 'MISS'
+        g.compressed_variants = entry.variants #compress_response从这里取已压缩的内容
+        response.set_etag(entry.etag)
+        response.vary.add('Cookie')
+        return response.make_conditional(request) #If-None-Match匹配时返回304
+    return wrapper
@@ -1,46 +1,82 @@
 import click
-from watchlist import app, db
-from watchlist.models import User, Movie
+from flask import Blueprint
+from sqlalchemy.exc import IntegrityError
+from watchlist import db
+from watchlist.models import User, Movie, MessageBoard
+from watchlist.cache import owner_cache
+from watchlist.transfer import (detect_format, read_rows, write_rows, bulk_insert, iter_table, movie_rows, message_rows,
+                                message_hashes, owner_usernames, owner_lookup)
 
 
-@app.cli.command() #注册为命令
+commands = Blueprint('commands', __name__, cli_group=None) #命令注册在顶层，如flask forge
+
+
+@commands.cli.command() #注册为命令
 def forge():
     db.create_all()
     name = '我，大烨'
     movielist = [
-        {'title': 'My Neighbor Totoro', 'year': '1988'},
-        {'title': 'Dead Poets Society', 'year': '1989'},
-        {'title': 'A Perfect World', 'year': '1993'},
-        {'title': 'Leon', 'year': '1994'},
-        {'title': 'Mahjong', 'year': '1996'},
-        {'title': 'Swallowtail Butterfly', 'year': '1996'},
-        {'title': 'King of Comedy', 'year': '1999'},
-        {'title': 'Devils on the Doorstep', 'year': '1999'},
-        {'title': 'WALL-E', 'year': '2008'},
-        {'title': 'The Pork of Music', 'year': '2012'},
+        {'title': 'My Neighbor Totoro', 'year': 1988},
+        {'title': 'Dead Poets Society', 'year': 1989},
+        {'title': 'A Perfect World', 'year': 1993},
+        {'title': 'Leon', 'year': 1994},
+        {'title': 'Mahjong', 'year': 1996},
+        {'title': 'Swallowtail Butterfly', 'year': 1996},
+        {'title': 'King of Comedy', 'year': 1999},
+        {'title': 'Devils on the Doorstep', 'year': 1999},
+        {'title': 'WALL-E', 'year': 2008},
+        {'title': 'The Pork of Music', 'year': 2012},
     ]
     user = User(name=name)
     db.session.add(user)
     for m in movielist:
-        movie = Movie(title=m['title'], year=m['year'])
+        movie = Movie(title=m['title'], year=m['year'], user=user)
         db.session.add(movie)
     db.session.commit()
+    owner_cache.invalidate()
     click.echo('Done.')
 
-@app.cli.command()
+@commands.cli.command()
 @click.option('--drop', is_flag=True, help='Create after drop.') #设置选项
 def initdb(drop): #重建数据库表
     if drop:
         db.drop_all()
+        owner_cache.invalidate()
     db.create_all()
     click.echo('Initialized database.')
 
-@app.cli.command()
+@commands.cli.command()
+def migratedb(): #升级已有数据库的表结构和索引
+    from watchlist.migrations import migrate
+    applied = migrate()
+    for name in applied:
+        click.echo('Applied %s.' % name)
+    click.echo('Database is up to date.')
+
+@commands.cli.command()
+def reindex(): #重建全文搜索索引
+    from watchlist.search import FTS_TABLES, create_fts, drop_fts, rebuild_fts
+    db.create_all()
+    if db.engine.dialect.name != 'sqlite':
+        click.echo('Full-text index is only used with SQLite.')
+        return
+    with db.engine.begin() as conn:
+        for table in FTS_TABLES:
+            drop_fts(conn, table) #重新创建，使SEARCH_TOKENIZER的修改生效
+            create_fts(conn, table)
+            rebuild_fts(conn, table)
+            click.echo('Rebuilt %s.' % FTS_TABLES[table][0])
+    click.echo('Done.')
+
+@commands.cli.command()
 @click.option('--username', prompt=True, help='The username used to login.')
 @click.option('--password', prompt=True, hide_input=True, confirmation_prompt=True, help='The password used to login.')
 def admin(username, password):
     db.create_all()
-    user = User.query.first()
+    user = User.query.order_by(User.id).first() #站长是id最小的用户，与首页显示的一致
+    other = User.query.filter_by(username=username).first()
+    if other is not None and other is not user: #登录按用户名查找，用户名不能重复
+        raise click.ClickException('Username %s already exists.' % username)
     if user is not None:
         click.echo('Updating user...')
         user.username = username
@@ -51,4 +87,166 @@ def admin(username, password):
         user.set_password(password)
         db.session.add(user)
     db.session.commit()
-    click.echo('Done.')
\ No newline at end of file
+    owner_cache.invalidate()
+    click.echo('Done.')
+
+@commands.cli.command('add-user')
+@click.option('--username', prompt=True, help='The username used to login.')
+@click.option('--name', prompt=True, help='The name shown on the watchlist.')
+@click.option('--password', prompt=True, hide_input=True, confirmation_prompt=True, help='The password used to login.')
+def add_user(username, name, password):
+    """Create another user with an empty watchlist."""
+    db.create_all()
+    if User.query.filter_by(username=username).first() is not None: #登录按用户名查找，用户名不能重复
+        raise click.ClickException('Username %s already exists.' % username)
+    user = User(username=username, name=name)
+    user.set_password(password)
+    db.session.add(user)
+    db.session.commit()
+    owner_cache.invalidate()
+    click.echo('Created user %s, watchlist at /u/%s.' % (username, username))
+
+@commands.cli.command('archive-messages')
+@click.option('--older-than', 'days', type=float, required=True, help='Archive messages older than this many days.')
+@click.option('--batch-size', default=1000, show_default=True, help='Messages per archive segment.')
+@click.option('--vacuum/--no-vacuum', default=True, show_default=True, help='Reclaim free pages afterwards.')
+@click.option('--incremental', is_flag=True, help='Switch the database to incremental auto-vacuum.')
+def archive_messages(days, batch_size, vacuum, incremental):
+    """Move old messages into gzip JSON Lines segments and shrink the database."""
+    from datetime import datetime, timedelta
+    from flask import current_app
+    from watchlist.archive import archive_messages as archive, compact
+    cutoff = datetime.now() - timedelta(days=days)
+    directory = current_app.config['ARCHIVE_DIR']
+    count = archive(cutoff, directory, batch_size)
+    click.echo('Archived %d messages to %s.' % (count, directory))
+    if vacuum and (count or incremental):
+        click.echo('Database compacted with %s.' % compact(incremental))
+
+FORMAT_OPTION = click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='File format, detected from the extension by default.')
+CHUNK_OPTION = click.option('--chunk-size', default=1000, show_default=True, help='Rows per INSERT/SELECT batch.')
+
+def _import(model, convert, stream, fmt, chunk_size):
+    db.create_all()
+    fmt = detect_format(stream.name, fmt)
+    try:
+        count = bulk_insert(model, convert(read_rows(stream, fmt)), chunk_size)
+    except (ValueError, IntegrityError) as e: #出错前的分块已经提交
+        db.session.rollback()
+        raise click.ClickException(str(e))
+    click.echo('Imported %d rows.' % count)
+
+def _export(model, columns, stream, fmt, chunk_size, convert=None, fields=None):
+    fmt = detect_format(stream.name, fmt)
+    rows = iter_table(model, columns, chunk_size)
+    count = write_rows(stream, convert(rows) if convert else rows, fields or columns, fmt)
+    click.echo('Exported %d rows.' % count, err=True) #输出到stdout时不混入数据
+
+@commands.cli.command('import-movies')
+@click.argument('file', type=click.File('r', encoding='utf-8'))
+@FORMAT_OPTION
+@CHUNK_OPTION
+@click.option('--user', 'username', help='Owner of all imported movies, overrides the owner column of the file. '
+                                         'Rows without an owner belong to the first user by default.')
+def import_movies(file, fmt, chunk_size, username):
+    """Import movies from a CSV or JSON Lines file."""
+    db.create_all()
+    query = User.query.filter_by(username=username) if username else User.query.order_by(User.id)
+    user = query.first()
+    if user is None:
+        raise click.ClickException('No such user, create one with flask admin or flask add-user first.')
+    lookup = None if username else owner_lookup() #未指定--user时按文件中的owner列
+    _import(Movie, lambda rows: movie_rows(rows, user.id, lookup), file, fmt, chunk_size)
+
+@commands.cli.command('export-movies')
+@click.argument('file', type=click.File('w', encoding='utf-8'))
+@FORMAT_OPTION
+@CHUNK_OPTION
+def export_movies(file, fmt, chunk_size):
+    """Export movies with their owner's username to a CSV or JSON Lines file."""
+    _export(Movie, ['id', 'title', 'year', 'user_id'], file, fmt, chunk_size,
+            convert=owner_usernames, fields=['id', 'title', 'year', 'owner'])
+
+@commands.cli.command('import-messages')
+@click.argument('file', type=click.File('r', encoding='utf-8'))
+@FORMAT_OPTION
+@CHUNK_OPTION
+def import_messages(file, fmt, chunk_size):
+    """Import message board posts from a CSV or JSON Lines file."""
+    repeated = [0]
+    def convert(rows):
+        for row in message_hashes(message_rows(rows), chunk_size):
+            if row['content_hash'] is None: #与已有留言重复的行照常导入，不参与去重
+                repeated[0] += 1
+            yield row
+    _import(MessageBoard, convert, file, fmt, chunk_size)
+    if repeated[0]:
+        click.echo('%d rows repeat earlier messages and were imported without a content hash.' % repeated[0])
+
+@commands.cli.command('export-messages')
+@click.argument('file', type=click.File('w', encoding='utf-8'))
+@FORMAT_OPTION
+@CHUNK_OPTION
+def export_messages(file, fmt, chunk_size):
+    """Export message board posts to a CSV or JSON Lines file."""
+    _export(MessageBoard, ['id', 'username', 'content', 'ctime'], file, fmt, chunk_size)
+
+@commands.cli.command('build-assets')
+def build_assets(): #生成带哈希的静态文件和预压缩版本，部署时执行
+    """Fingerprint and precompress the static files into static/dist."""
+    from flask import current_app
+    from watchlist.assets import build_assets as build
+    manifest = build(current_app.static_folder)
+    for source in sorted(manifest):
+        click.echo('%s -> %s' % (source, manifest[source]))
+    current_app.extensions['assets'] = manifest
+    #命令在单独的进程中执行，服务器进程重启后才会读取新的manifest，旧地址的文件仍然保留
+    click.echo('Built %d assets. Restart the server to pick up the new manifest.' % len(manifest))
+
+@commands.cli.command('db-stats')
+def db_stats(): #查看表行数、索引使用情况、数据库文件和WAL大小
+    """Show row counts, index usage and SQLite file statistics."""
+    from flask import current_app
+    from watchlist.diagnostics import table_stats, file_stats, route_queries, query_plans, index_usage
+    sqlite = db.engine.dialect.name == 'sqlite'
+    queries = route_queries(current_app) if sqlite else []
+    with db.engine.connect() as conn:
+        tables = table_stats(conn)
+        usage = index_usage(query_plans(conn, queries))
+        files = file_stats(conn) if sqlite else None
+    click.echo('Tables:')
+    for name, count, indexes in tables:
+        click.echo('  %-16s %10d rows' % (name, count))
+        for index, columns in indexes:
+            used = ', '.join(usage.get(index, [])) or ('unused by route queries' if sqlite else '-')
+            click.echo('    %s (%s): %s' % (index, ', '.join(columns), used))
+    if files is None:
+        click.echo('Page and query plan statistics are only available with SQLite.')
+        return
+    click.echo('Pages: %d x %d bytes, %d free' % (files['page_count'], files['page_size'], files['freelist_count']))
+    wal = 'no WAL file' if files['wal_size'] is None else 'WAL file %d bytes' % files['wal_size']
+    click.echo('Journal mode: %s, %s' % (files['journal_mode'], wal))
+
+@commands.cli.command()
+def explain(): #输出各路由查询的执行计划，全表扫描时以非零状态退出，可以在CI中检查
+    """Show EXPLAIN QUERY PLAN for the queries issued by each route."""
+    from flask import current_app
+    from watchlist.diagnostics import route_queries, query_plans, is_full_scan
+    if db.engine.dialect.name != 'sqlite':
+        raise click.ClickException('Query plans are only available with SQLite.')
+    queries = route_queries(current_app) #通过test_client请求各路由，记录实际执行的语句
+    with db.engine.connect() as conn:
+        plans = query_plans(conn, queries)
+    full_scans = 0
+    for route, label, statement, details in plans:
+        click.echo('%s: %s' % (route, label))
+        click.echo('  %s' % statement)
+        for detail in details:
+            if is_full_scan(detail, statement, details):
+                full_scans += 1
+                click.echo('    %s  <-- full table scan' % detail)
+            else:
+                click.echo('    %s' % detail)
+    if full_scans:
+        raise click.ClickException('%d full table scans found.' % full_scans)
+    click.echo('No full table scans.')
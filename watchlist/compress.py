@@ -0,0 +1,101 @@
+import zlib
+from flask import g, request
+
+try: #brotli是可选依赖，没有安装时只使用gzip
+    import brotli
+except ImportError:
+    brotli = None
+
+
+#对HTML和JSON响应统一做gzip/brotli压缩，流式响应逐块压缩，边生成边发送
+STREAM_BLOCK_SIZE = 8192 #流式响应攒够这么多字节再压缩发送一次
+
+
+class _Gzip(object):
+    def __init__(self, level):
+        self._obj = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS) #16+表示gzip格式
+
+    def compress(self, data) -> bytes:
+        return self._obj.compress(data) + self._obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._obj.flush()
+
+
+class _Brotli(object):
+    def __init__(self, level):
+        self._obj = brotli.Compressor(quality=level)
+
+    def compress(self, data) -> bytes:
+        return self._obj.process(data) + self._obj.flush()
+
+    def finish(self) -> bytes:
+        return self._obj.finish()
+
+
+def choose_encoding(accept_encodings, config):
+    """按Accept-Encoding选择编码，返回(编码, 压缩级别)，不压缩时返回(None, None)。"""
+    if brotli is not None and 'br' in accept_encodings:
+        return 'br', config['COMPRESS_BR_LEVEL']
+    if 'gzip' in accept_encodings:
+        return 'gzip', config['COMPRESS_LEVEL']
+    return None, None
+
+def compressor(encoding, level):
+    return _Brotli(level) if encoding == 'br' else _Gzip(level)
+
+def compress_body(data, encoding, level) -> bytes:
+    obj = compressor(encoding, level)
+    return obj.compress(data) + obj.finish()
+
+def cached_compress(variants, data, encoding, level) -> bytes:
+    """variants为页面缓存中的{编码: 压缩后的内容}，已有时直接返回，没有时压缩并保存；不是缓存的页面时为None。"""
+    body = variants.get(encoding) if variants is not None else None
+    if body is None:
+        body = compress_body(data, encoding, level)
+        if variants is not None:
+            variants[encoding] = body
+    return body
+
+def compress_stream(chunks, encoding, level):
+    obj = compressor(encoding, level)
+    buffer = []
+    size = 0
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= STREAM_BLOCK_SIZE: #模板逐条语句输出，很小的块单独压缩效果很差
+            yield obj.compress(b''.join(buffer))
+            buffer, size = [], 0
+    yield obj.compress(b''.join(buffer)) + obj.finish()
+
+
+def init_compression(app):
+    @app.after_request
+    def compress_response(response):
+        config = app.config
+        #304、206等响应不压缩
+        if (not config['COMPRESS_ENABLED'] or response.mimetype not in config['COMPRESS_MIMETYPES']
+                or response.status_code != 200):
+            return response
+        response.vary.add('Accept-Encoding')
+        #send_file返回的文件不经过这里压缩，静态文件使用flask build-assets生成的预压缩版本
+        if response.direct_passthrough or 'Content-Encoding' in response.headers:
+            return response
+        encoding, level = choose_encoding(request.accept_encodings, config)
+        if encoding is None:
+            return response
+        if response.is_streamed:
+            response.response = compress_stream(response.response, encoding, level)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < config['COMPRESS_MIN_SIZE']: #太小的响应压缩后可能反而变大
+                return response
+            response.set_data(cached_compress(g.get('compressed_variants'), data, encoding, level))
+        response.headers['Content-Encoding'] = encoding
+        if response.get_etag()[0]: #压缩后的内容与ETag对应的内容不同，改为弱ETag
+            response.set_etag(response.get_etag()[0], weak=True)
+        return response
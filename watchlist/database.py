@@ -0,0 +1,62 @@
+from datetime import datetime
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.pool import QueuePool
+
+
+_dialect = sqlite.dialect()
+
+
+def is_sqlite_file(sa_url) -> bool:
+    return sa_url.drivername.startswith('sqlite') and sa_url.database not in (None, '', ':memory:')
+
+
+class TunedSQLAlchemy(SQLAlchemy): #根据配置调整SQLite连接池和PRAGMA，其他数据库保持默认
+    def apply_driver_hacks(self, app, sa_url, options):
+        super(TunedSQLAlchemy, self).apply_driver_hacks(app, sa_url, options)
+        pool_size = app.config['SQLITE_POOL_SIZE']
+        if is_sqlite_file(sa_url) and pool_size:
+            #默认的NullPool每次请求都重新打开文件并执行PRAGMA，改为复用连接
+            options['poolclass'] = QueuePool
+            options['pool_size'] = pool_size
+            options.setdefault('max_overflow', pool_size)
+            connect_args = options.setdefault('connect_args', {})
+            connect_args['check_same_thread'] = False #连接会在线程池中的不同线程间复用
+            connect_args['timeout'] = app.config['SQLITE_BUSY_TIMEOUT'] / 1000.0
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super(TunedSQLAlchemy, self).create_engine(sa_url, engine_opts)
+        if sa_url.drivername.startswith('sqlite'):
+            pragmas = sqlite_pragmas(self.get_app().config, is_sqlite_file(sa_url))
+            event.listen(engine, 'connect', lambda dbapi_conn, record: apply_pragmas(dbapi_conn, pragmas))
+        return engine
+
+
+def sqlite_pragmas(config, on_disk=True) -> list:
+    pragmas = [
+        ('busy_timeout', int(config['SQLITE_BUSY_TIMEOUT'])),
+        ('synchronous', config['SQLITE_SYNCHRONOUS']),
+        ('cache_size', int(config['SQLITE_CACHE_SIZE'])),
+    ]
+    if on_disk: #内存数据库不支持WAL，也没有可映射的文件
+        pragmas.insert(0, ('journal_mode', config['SQLITE_JOURNAL_MODE']))
+        pragmas.append(('mmap_size', int(config['SQLITE_MMAP_SIZE'])))
+    return pragmas
+
+def apply_pragmas(dbapi_conn, pragmas):
+    cursor = dbapi_conn.cursor()
+    for name, value in pragmas:
+        cursor.execute('PRAGMA %s = %s' % (name, value))
+    cursor.close()
+
+def compile_query(query):
+    """把Core查询编译为SQLite语句和按位置排列的参数，供不经过SQLAlchemy连接的驱动执行。"""
+    compiled = query.compile(dialect=_dialect)
+    params = []
+    for name in compiled.positiontup:
+        value = compiled.params[name]
+        if isinstance(value, datetime): #与SQLAlchemy写入DateTime时的格式一致
+            value = value.strftime('%Y-%m-%d %H:%M:%S.%f')
+        params.append(value)
+    return str(compiled), params
@@ -0,0 +1,131 @@
+import os
+import re
+import uuid
+from datetime import datetime
+from sqlalchemy import event
+from watchlist import db, init_views
+from watchlist.database import is_sqlite_file
+from watchlist.models import User, Movie
+
+
+#数据库诊断：表行数、索引、页数、WAL大小，以及各路由实际执行的查询的执行计划，供flask db-stats和flask explain使用
+#逐行扫描，例如"SCAN movie"，或按索引顺序扫描"SCAN message_board USING INDEX ix_message_board_ctime"
+SCAN = re.compile(r'^SCAN (?:TABLE )?\w+(?P<index> USING (?:COVERING )?INDEX \w+)?$')
+USING_INDEX = re.compile(r'USING (?:COVERING )?INDEX (\w+)')
+TEMP_SORT = re.compile(r'^USE TEMP B-TREE FOR')
+
+
+def _route_requests() -> list:
+    """返回[(路由, 请求, test_client参数)]，需要登录的页面以第一个用户的身份访问。"""
+    now = datetime.utcnow().isoformat()
+    probe = 'explain-%s' % uuid.uuid4().hex #每次使用新的IP和用户名，不会被登录失败限速拦截
+    requests = [
+        ('index', 'GET /', dict(path='/')),
+        ('index', 'GET /?after=1', dict(path='/?after=1')),
+        ('messageboard', 'GET /messageboard', dict(path='/messageboard')),
+        ('messageboard', 'GET /messageboard?after=<ctime>,1', dict(path='/messageboard?after=%s,1' % now)),
+        ('login', 'POST /login', dict(path='/login', method='POST', data={'username': probe, 'password': probe},
+                                      environ_base={'REMOTE_ADDR': probe})),
+    ]
+    #只查询id，不把对象放进会话，路由加载登录用户时会真正执行查询
+    user_id = db.session.query(User.id).order_by(User.id).limit(1).scalar()
+    if user_id is not None:
+        movie_id = db.session.query(Movie.id).filter_by(user_id=user_id).order_by(Movie.id).limit(1).scalar()
+        path = '/movie/edit/%d' % (movie_id or 0)
+        requests.append(('edit', 'GET ' + path, dict(path=path, user_id=user_id)))
+    return requests
+
+def capture_queries(app, path, user_id=None, **kwargs) -> list:
+    """用test_client请求path，返回路由实际执行的[(SQL, 参数)]。"""
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+    client = app.test_client()
+    if user_id is not None:
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+            session['_fresh'] = True
+    ttl = app.config['PAGE_CACHE_TTL']
+    app.config['PAGE_CACHE_TTL'] = 0 #命中页面缓存时不会执行查询
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        client.open(path, **kwargs)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+        app.config['PAGE_CACHE_TTL'] = ttl
+    return statements
+
+def route_queries(app) -> list:
+    """返回[(路由, 请求, SQL, 参数)]，同一请求中重复的语句只保留一次。站长信息有进程内缓存，不一定出现在结果中。"""
+    init_views(app)
+    queries = []
+    for route, label, kwargs in _route_requests():
+        seen = set()
+        for statement, parameters in capture_queries(app, **kwargs):
+            if statement in seen or not statement.lstrip().upper().startswith('SELECT'):
+                continue
+            seen.add(statement)
+            queries.append((route, label, ' '.join(statement.split()), parameters))
+    return queries
+
+
+def explain(conn, statement, parameters=()) -> list:
+    """返回EXPLAIN QUERY PLAN每一步的说明。"""
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+        return [row[-1] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+def is_full_scan(detail, statement='', details=()) -> bool:
+    """没有用索引定位起点的扫描。带WHERE的语句按索引顺序SCAN时，条件只能逐行检查，同样算全表扫描；
+    没有WHERE也不需要排序的LIMIT查询（例如读取站长、留言板第一页）只读前几行，不算。"""
+    match = SCAN.match(detail)
+    if match is None:
+        return False
+    where = ' WHERE ' in statement
+    if match.group('index'):
+        return where
+    first_rows = ' LIMIT ' in statement and not where and not any(TEMP_SORT.match(step) for step in details)
+    return not first_rows
+
+def query_plans(conn, queries) -> list:
+    """返回[(路由, 请求, SQL, [执行计划每一步])]，queries为route_queries的结果。"""
+    return [(route, label, statement, explain(conn, statement, parameters))
+            for route, label, statement, parameters in queries]
+
+def index_usage(plans) -> dict:
+    """返回{索引名: [使用它的路由]}，SQLite不记录索引的使用次数，以路由查询的执行计划为准。"""
+    usage = {}
+    for route, label, statement, details in plans:
+        for detail in details:
+            for name in USING_INDEX.findall(detail):
+                routes = usage.setdefault(name, [])
+                if route not in routes:
+                    routes.append(route)
+    return usage
+
+
+def table_stats(conn) -> list:
+    """返回[(表名, 行数, [(索引名, 列)])]，只包含模型对应的表。"""
+    inspector = db.inspect(conn)
+    existing = set(inspector.get_table_names())
+    stats = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing:
+            continue
+        count = conn.execute(db.select([db.func.count()]).select_from(table)).scalar()
+        indexes = [(index['name'], index['column_names']) for index in inspector.get_indexes(table.name)]
+        stats.append((table.name, count, indexes))
+    return stats
+
+def file_stats(conn) -> dict:
+    """SQLite数据库文件的页数、空闲页数、日志模式和WAL文件大小。"""
+    stats = dict((name, conn.execute('PRAGMA %s' % name).scalar())
+                 for name in ('page_size', 'page_count', 'freelist_count', 'journal_mode'))
+    stats['wal_size'] = None
+    if is_sqlite_file(conn.engine.url):
+        wal = conn.engine.url.database + '-wal'
+        stats['wal_size'] = os.path.getsize(wal) if os.path.exists(wal) else 0
+    return stats
@@ -1,15 +1,24 @@
-from watchlist import app
-from flask import render_template
+from flask import Blueprint, render_template, request, jsonify
 
 
-@app.errorhandler(404) #传入要处理的错误代码
+errors = Blueprint('errors', __name__)
+
+
+def wants_json() -> bool: #接口请求返回JSON格式的错误信息
+    return request.path.startswith('/api/')
+
+@errors.app_errorhandler(404) #传入要处理的错误代码
 def page_not_found(e) -> 'html':
+    if wants_json():
+        return jsonify(error='not found'), 404
     return render_template('errors/404.html'), 404
 
-@app.errorhandler(400)
+@errors.app_errorhandler(400)
 def bad_request(e):
+    if wants_json():
+        return jsonify(error='bad request'), 400
     return render_template('errors/400.html'), 400
 
-@app.errorhandler(500)
+@errors.app_errorhandler(500)
 def internal_server_error(e):
     return render_template('errors/500.html'), 500
\ No newline at end of file
@@ -0,0 +1,65 @@
+import threading
+from collections import OrderedDict
+
+
+_MISSING = object()
+
+
+class LRUCache(object): #加锁的LRU字典，进程内的各种缓存和限速器共用，超过max_size时淘汰最久未使用的项
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._entries.get(key, _MISSING)
+            if value is _MISSING:
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, max_size=None):
+        """写入一项，max_size为None时使用构造时的大小。"""
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            self._evict(self.max_size if max_size is None else max_size)
+
+    def setdefault(self, key, factory):
+        """返回key对应的值，不存在时写入factory()的返回值。"""
+        with self._lock:
+            value = self._entries.get(key, _MISSING)
+            if value is _MISSING:
+                value = self._entries[key] = factory()
+                self._evict(self.max_size)
+            else:
+                self._entries.move_to_end(key)
+            return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._entries.pop(key, default)
+
+    def remove_if(self, predicate):
+        """删除predicate(key)为真的项。"""
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+
+    def keys(self) -> list:
+        with self._lock:
+            return list(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _evict(self, max_size):
+        if max_size is not None:
+            while len(self._entries) > max_size:
+                self._entries.popitem(last=False)
@@ -0,0 +1,129 @@
+import threading
+import time
+from collections import defaultdict
+from flask import request, abort
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from watchlist.spam import post_counters
+
+
+#按视图统计SQL次数、SQL耗时、模板渲染耗时和总耗时，METRICS_ENABLED关闭时每个钩子只做一次判断
+
+_local = threading.local()
+
+
+class RequestStats(object):
+    __slots__ = ('start', 'queries', 'db_time', 'render_time')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.render_time = 0.0
+
+
+class MetricsCollector(object): #进程内汇总，/metrics以Prometheus文本格式输出
+    FIELDS = ('requests', 'queries', 'db_seconds', 'render_seconds', 'seconds')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = defaultdict(lambda: dict.fromkeys(self.FIELDS, 0))
+
+    def record(self, endpoint, stats, total):
+        with self._lock:
+            totals = self._totals[endpoint]
+            totals['requests'] += 1
+            totals['queries'] += stats.queries
+            totals['db_seconds'] += stats.db_time
+            totals['render_seconds'] += stats.render_time
+            totals['seconds'] += total
+
+    def reset(self):
+        with self._lock:
+            self._totals.clear()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict((endpoint, dict(totals)) for endpoint, totals in self._totals.items())
+
+    def render(self) -> str:
+        metrics = [
+            ('requests', 'watchlist_requests_total', 'counter', 'Requests handled.'),
+            ('queries', 'watchlist_db_queries_total', 'counter', 'SQL statements executed.'),
+            ('db_seconds', 'watchlist_db_seconds_total', 'counter', 'Time spent executing SQL.'),
+            ('render_seconds', 'watchlist_render_seconds_total', 'counter', 'Time spent rendering templates.'),
+            ('seconds', 'watchlist_request_seconds_total', 'counter', 'Total request latency.'),
+        ]
+        snapshot = self.snapshot()
+        lines = []
+        for field, name, kind, help_text in metrics:
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for endpoint in sorted(snapshot):
+                lines.append('%s{endpoint="%s"} %s' % (name, endpoint, _format(snapshot[endpoint][field])))
+        return '\n'.join(lines) + '\n'
+
+
+def _format(value) -> str:
+    return repr(round(value, 6)) if isinstance(value, float) else str(value)
+
+
+collector = MetricsCollector()
+
+
+class TimedTemplate(Template): #只统计顶层模板，extends/include在同一次render中完成
+    def render(self, *args, **kwargs):
+        stats = getattr(_local, 'stats', None)
+        if stats is None:
+            return super(TimedTemplate, self).render(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return super(TimedTemplate, self).render(*args, **kwargs)
+        finally:
+            stats.render_time += time.perf_counter() - start
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = getattr(_local, 'stats', None)
+    if stats is not None and conn.info.get('query_start'):
+        stats.queries += 1
+        stats.db_time += time.perf_counter() - conn.info['query_start'].pop()
+
+
+def init_metrics(app):
+    app.jinja_env.template_class = TimedTemplate
+
+    @app.before_request
+    def start_timer():
+        if app.config['METRICS_ENABLED']:
+            _local.stats = RequestStats()
+
+    @app.after_request
+    def record_timing(response):
+        stats = getattr(_local, 'stats', None)
+        if stats is None:
+            return response
+        _local.stats = None
+        total = time.perf_counter() - stats.start
+        collector.record(request.endpoint or 'unknown', stats, total)
+        response.headers.add('Server-Timing', 'db;dur=%.2f;desc="%d queries", render;dur=%.2f, total;dur=%.2f'
+                             % (stats.db_time * 1000, stats.queries, stats.render_time * 1000, total * 1000))
+        return response
+
+    @app.teardown_request
+    def clear_timer(exc):
+        _local.stats = None #出现异常时after_request不会执行
+
+    @app.route('/metrics')
+    def metrics():
+        if not app.config['METRICS_ENABLED']:
+            abort(404)
+        return app.response_class(collector.render() + post_counters.render(), mimetype='text/plain; version=0.0.4')
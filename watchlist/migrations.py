@@ -0,0 +1,138 @@
+from datetime import datetime
+from watchlist import db
+from watchlist.models import User, Movie, MessageBoard
+from watchlist.spam import message_hash
+from watchlist.search import FTS_TABLES, configured_tokenizer, create_fts, drop_fts, fts_tokenizer, rebuild_fts
+
+
+#已有的data.db升级到当前模型结构，每个步骤都可以重复执行
+
+def _sqlite_column_type(conn, table, column) -> str:
+    for row in conn.execute('PRAGMA table_info(%s)' % table):
+        if row['name'] == column:
+            return row['type'].upper()
+    return ''
+
+def movie_year_integer(conn) -> bool:
+    #旧版本的year是VARCHAR(4)，按字符串比较无法走索引做范围查询
+    if conn.dialect.name != 'sqlite' or not _sqlite_column_type(conn, 'movie', 'year').startswith('VARCHAR'):
+        return False
+    #SQLite不能修改列类型，需要重建表，全文索引和触发器随新表重新创建
+    drop_fts(conn, 'movie')
+    conn.execute('ALTER TABLE movie RENAME TO _movie_old')
+    db.metadata.tables['movie'].create(conn)
+    conn.execute('INSERT INTO movie (id, title, year) '
+                 'SELECT id, title, CAST(year AS INTEGER) FROM _movie_old')
+    conn.execute('DROP TABLE _movie_old')
+    return True
+
+def add_updated_at(conn) -> bool:
+    #列表行片段缓存以updated_at为版本，旧数据的版本取留言时间或迁移时间
+    changed = False
+    inspector = db.inspect(conn)
+    for model in (Movie, MessageBoard):
+        table = model.__table__
+        if 'updated_at' not in set(column['name'] for column in inspector.get_columns(table.name)):
+            conn.execute('ALTER TABLE %s ADD COLUMN updated_at %s'
+                         % (table.name, table.c.updated_at.type.compile(dialect=conn.dialect)))
+            changed = True
+        value = table.c.ctime if 'ctime' in table.c else datetime.now()
+        result = conn.execute(table.update().where(table.c.updated_at.is_(None)).values(updated_at=value))
+        changed = changed or result.rowcount > 0
+    return changed
+
+def add_movie_owner(conn) -> bool:
+    #单用户版本的电影没有所属用户，全部归到第一个用户；需要在创建(user_id, id)索引之前执行
+    changed = False
+    table = Movie.__table__
+    if 'user_id' not in set(column['name'] for column in db.inspect(conn).get_columns('movie')):
+        conn.execute('ALTER TABLE movie ADD COLUMN user_id INTEGER REFERENCES %s (id)'
+                     % conn.dialect.identifier_preparer.quote(User.__tablename__))
+        changed = True
+    owner_id = conn.execute(db.select([User.id]).order_by(User.id).limit(1)).scalar()
+    if owner_id is not None:
+        #显示内容没有变化，保留updated_at，不触发onupdate
+        result = conn.execute(table.update().where(table.c.user_id.is_(None))
+                              .values(user_id=owner_id, updated_at=table.c.updated_at))
+        changed = changed or result.rowcount > 0
+    return changed
+
+def add_content_hash(conn) -> bool:
+    #已有留言计算内容hash，重复的留言只保留第一条的hash，需要在创建唯一索引之前执行
+    changed = False
+    table = MessageBoard.__table__
+    if 'content_hash' not in set(column['name'] for column in db.inspect(conn).get_columns(table.name)):
+        conn.execute('ALTER TABLE %s ADD COLUMN content_hash %s'
+                     % (table.name, table.c.content_hash.type.compile(dialect=conn.dialect)))
+        changed = True
+    seen = set(row[0] for row in conn.execute(db.select([table.c.content_hash]).where(table.c.content_hash.isnot(None))))
+    updates = []
+    for row in conn.execute(db.select([table.c.id, table.c.username, table.c.content])
+                            .where(table.c.content_hash.is_(None)).order_by(table.c.id)).fetchall():
+        digest = message_hash(row.username, row.content)
+        if digest not in seen:
+            seen.add(digest)
+            updates.append(dict(row_id=row.id, digest=digest))
+    if updates:
+        conn.execute(table.update().where(table.c.id == db.bindparam('row_id'))
+                     .values(content_hash=db.bindparam('digest'), updated_at=table.c.updated_at), updates)
+        changed = True
+    return changed
+
+def unique_username(conn) -> bool:
+    #登录按用户名查找第一个用户，重名的其他用户无法登录；保留id最小的用户名，其他的改为"用户名_id"，
+    #再删除不唯一的索引，由create_missing_indexes重建为唯一索引
+    changed = False
+    table = User.__table__
+    seen = set()
+    for row in conn.execute(db.select([table.c.id, table.c.username])
+                            .where(table.c.username.isnot(None)).order_by(table.c.id)).fetchall():
+        if row.username in seen:
+            suffix = '_%d' % row.id
+            conn.execute(table.update().where(table.c.id == row.id)
+                         .values(username=row.username[:20 - len(suffix)] + suffix))
+            changed = True
+        seen.add(row.username)
+    for index in db.inspect(conn).get_indexes(table.name):
+        if index['name'] == 'ix_user_username' and not index['unique']:
+            conn.execute('DROP INDEX %s' % index['name'])
+            changed = True
+    return changed
+
+def create_missing_indexes(conn) -> bool:
+    inspector = db.inspect(conn)
+    created = False
+    for table in db.metadata.sorted_tables:
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(conn)
+                created = True
+    return created
+
+def create_search_index(conn) -> bool:
+    if conn.dialect.name != 'sqlite':
+        return False
+    created = False
+    for table in FTS_TABLES:
+        tokenizer = fts_tokenizer(conn, table)
+        if tokenizer != configured_tokenizer(): #没有索引表，或者分词器的配置改变了
+            if tokenizer is not None:
+                drop_fts(conn, table)
+            create_fts(conn, table)
+            rebuild_fts(conn, table) #为已有数据建立索引
+            created = True
+    return created
+
+STEPS = [movie_year_integer, add_updated_at, add_movie_owner, add_content_hash, unique_username,
+         create_missing_indexes, create_search_index]
+
+def migrate() -> list:
+    """在一个事务中执行所有迁移步骤，返回实际执行了的步骤名称。"""
+    db.create_all() #补充缺少的表
+    applied = []
+    with db.engine.begin() as conn:
+        for step in STEPS:
+            if step(conn):
+                applied.append(step.__name__)
+    return applied
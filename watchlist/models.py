@@ -1,27 +1,52 @@
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+from flask import current_app
 from flask_login import UserMixin
 from watchlist import db
+from watchlist.spam import message_hash
 from datetime import datetime
 
 
+def _hash_method(method) -> str:
+    """补全Werkzeug写入hash时省略的默认值，例如pbkdf2:sha256保存为pbkdf2:sha256:150000。"""
+    parts = method.split(':')
+    if parts[0] != 'pbkdf2':
+        return method
+    hash_name = parts[1] if len(parts) > 1 and parts[1] else 'sha256'
+    iterations = int(parts[2]) if len(parts) > 2 and parts[2] else DEFAULT_PBKDF2_ITERATIONS
+    return 'pbkdf2:%s:%d' % (hash_name, iterations)
+
 class User(db.Model, UserMixin): #模型类，数据库表的对象关系映射。
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(20))
-    username = db.Column(db.String(20))
+    username = db.Column(db.String(20), index=True, unique=True) #登录时按用户名查询，不能重复
     password_hash = db.Column(db.String(128))
+    movies = db.relationship('Movie', backref='user', lazy='dynamic') #每个用户有自己的电影清单
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password) #将密码进行hash加密后保存变量
+        self.password_hash = generate_password_hash(password, method=current_app.config['PASSWORD_HASH_METHOD'],
+                                                    salt_length=current_app.config['PASSWORD_SALT_LENGTH']) #将密码进行hash加密后保存变量
     def validate_password(self, password) -> bool:
         return check_password_hash(self.password_hash, password) #返回bool值
+    def needs_rehash(self) -> bool: #hash方法或迭代次数与当前配置不同
+        return self.password_hash.split('$', 1)[0] != _hash_method(current_app.config['PASSWORD_HASH_METHOD'])
 
 class Movie(db.Model):
+    #按用户分页 WHERE user_id = ? AND id > ? ORDER BY id 只扫描该用户的索引范围
+    __table_args__ = (db.Index('ix_movie_user_id_id', 'user_id', 'id'),)
     id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     title = db.Column(db.String(60))
-    year = db.Column(db.String(4))
+    year = db.Column(db.Integer, index=True) #整数类型，可以按索引做范围查询和排序
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now) #列表行片段缓存的版本
+
+def _message_hash(context): #ORM、批量写入和导入都会自动计算
+    params = context.get_current_parameters()
+    return message_hash(params['username'], params['content'])
 
 class MessageBoard(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(20))
     content = db.Column(db.String(200))
-    ctime = db.Column(db.DateTime, default=datetime.now)
+    ctime = db.Column(db.DateTime, default=datetime.now, index=True) #留言按时间排序分页
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+    content_hash = db.Column(db.String(40), default=_message_hash, unique=True, index=True) #相同的留言只能写入一次
@@ -0,0 +1,95 @@
+from datetime import datetime
+from flask import abort
+from watchlist import db
+
+
+class KeysetPage(object): #游标分页结果，只保存当前页的数据和前后页游标
+    def __init__(self, items, total, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.total = total
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self) -> bool:
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self) -> bool:
+        return self.prev_cursor is not None
+
+
+def encode_cursor(row, columns) -> str:
+    values = []
+    for column in columns:
+        value = getattr(row, column.key)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        values.append(str(value))
+    return ','.join(values)
+
+def decode_cursor(cursor, columns) -> list:
+    parts = cursor.split(',')
+    if len(parts) != len(columns):
+        abort(400)
+    values = []
+    try:
+        for part, column in zip(parts, columns):
+            python_type = column.type.python_type
+            if python_type is datetime:
+                values.append(datetime.fromisoformat(part))
+            else:
+                values.append(python_type(part))
+    except ValueError:
+        abort(400) #游标格式错误
+    return values
+
+def _keyset_filter(columns, values, forward):
+    #(a, b) > (x, y) 展开为 a > x OR (a = x AND b > y)，兼容不支持行值比较的数据库
+    clauses = []
+    for i, column in enumerate(columns):
+        terms = [columns[j] == values[j] for j in range(i)]
+        terms.append(column > values[i] if forward else column < values[i])
+        clauses.append(db.and_(*terms))
+    if len(clauses) == 1:
+        return clauses[0]
+    #OR条件无法用索引定位起点，多加一个冗余的 a >= x，数据库从游标处开始按索引查找，翻到最后一页也不会变慢
+    leading = columns[0] >= values[0] if forward else columns[0] <= values[0]
+    return db.and_(leading, db.or_(*clauses))
+
+def count_rows(model, *criterion) -> int:
+    #只执行COUNT(*)，不加载整张表，带条件时只扫描对应的索引范围
+    return db.session.query(db.func.count()).select_from(model).filter(*criterion).scalar()
+
+def keyset_clauses(columns, after=None, before=None, descending=False):
+    """返回(过滤条件, 排序, 是否向前翻页, 游标)，ORM查询和Core查询都可以使用。"""
+    backward = bool(before) and not after
+    cursor = before if backward else after
+    #按显示顺序取下一页时方向为forward，升序时即为大于
+    ascending = descending == backward
+    criterion = None
+    if cursor:
+        criterion = _keyset_filter(columns, decode_cursor(cursor, columns), ascending)
+    order = [column.asc() if ascending else column.desc() for column in columns]
+    return criterion, order, backward, cursor
+
+def build_page(rows, columns, per_page, backward, cursor, total=None):
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backward:
+        rows.reverse()
+    next_cursor = prev_cursor = None
+    if rows:
+        if (has_more and not backward) or (backward and cursor):
+            next_cursor = encode_cursor(rows[-1], columns)
+        if (has_more and backward) or (not backward and cursor):
+            prev_cursor = encode_cursor(rows[0], columns)
+    return KeysetPage(rows, total, next_cursor, prev_cursor)
+
+def paginate_keyset(query, columns, per_page, after=None, before=None, descending=False, total=None):
+    """按columns做游标分页，after/before为上一页返回的游标字符串。"""
+    criterion, order, backward, cursor = keyset_clauses(columns, after, before, descending)
+    if criterion is not None:
+        query = query.filter(criterion)
+    rows = query.order_by(*order).limit(per_page + 1).all()
+    return build_page(rows, columns, per_page, backward, cursor, total)
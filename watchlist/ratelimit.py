@@ -0,0 +1,46 @@
+import threading
+import time
+from watchlist.lru import LRUCache
+
+
+class TokenBucketLimiter(object): #进程内令牌桶，按LRU淘汰最久未使用的键，内存占用有上限
+    def __init__(self, max_keys=10000):
+        self._lock = threading.Lock() #令牌数的读取和修改需要一起完成
+        self._buckets = LRUCache(max_keys) #键 -> [剩余令牌数, 上次更新时间]
+
+    def _bucket(self, key, rate, burst, now):
+        bucket = self._buckets.setdefault(key, lambda: [float(burst), now])
+        bucket[0] = min(float(burst), bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        return bucket
+
+    def consume_all(self, keys, rate, burst) -> bool:
+        """每个键都有令牌时各消耗一个，否则都不消耗。检查和扣除在同一把锁内，并发请求不会同时通过。"""
+        with self._lock:
+            now = time.monotonic()
+            buckets = [self._bucket(key, rate, burst, now) for key in keys]
+            if any(bucket[0] < 1 for bucket in buckets):
+                return False
+            for bucket in buckets:
+                bucket[0] -= 1
+            return True
+
+    def refund(self, keys, rate, burst):
+        """退还consume_all消耗的令牌。"""
+        with self._lock:
+            now = time.monotonic()
+            for key in keys:
+                bucket = self._bucket(key, rate, burst, now)
+                bucket[0] = min(float(burst), bucket[0] + 1)
+
+    def consume(self, key, rate, burst) -> bool:
+        """消耗一个令牌，没有令牌时返回False。"""
+        with self._lock:
+            bucket = self._bucket(key, rate, burst, time.monotonic())
+            if bucket[0] < 1:
+                return False
+            bucket[0] -= 1
+            return True
+
+    def reset(self):
+        self._buckets.clear()
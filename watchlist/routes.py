@@ -1,103 +1,254 @@
-from flask import render_template, request, url_for, redirect, flash
+from flask import Blueprint, Response, abort, current_app, render_template, request, url_for, redirect, flash, session
 from flask_login import login_user, login_required, logout_user, current_user
-from watchlist import app, db
+from sqlalchemy.exc import IntegrityError
+from werkzeug.security import generate_password_hash, check_password_hash
+from watchlist import db, message_writer
 from watchlist.models import User, Movie, MessageBoard
+from watchlist.pagination import paginate_keyset, count_rows
+from watchlist.cache import Owner, owner_cache, page_cache, cached_page, get_owner
+from watchlist.ratelimit import TokenBucketLimiter
+from watchlist.spam import message_hash, message_limiter, recent_hashes, post_counters
+from watchlist.search import search_movies, search_messages
+from watchlist.stream import message_broker, event_stream
+from watchlist.archive import list_segments, load_segment, segment_summary
+from watchlist.templating import render_page
 
 
-@app.route('/', methods=['GET', 'POST'])
+main = Blueprint('main', __name__)
+login_limiter = TokenBucketLimiter() #记录登录失败次数
+_dummy_hashes = {}
+
+def invalidate_movie_pages():
+    page_cache.invalidate('main.index')
+    page_cache.invalidate('main.user_movies')
+
+def render_movies(owner):
+    """显示owner的电影清单，按(user_id, id)索引分页，耗时只与该用户的电影数量有关。"""
+    owner_id = owner.id if owner is not None else None
+    pagination = paginate_keyset(Movie.query.filter_by(user_id=owner_id), [Movie.id], current_app.config['MOVIES_PER_PAGE'],
+                                 after=request.args.get('after'), before=request.args.get('before'),
+                                 total=count_rows(Movie, Movie.user_id == owner_id))
+    editable = current_user.is_authenticated and current_user.id == owner_id #只能编辑自己的清单
+    return render_page('index.html', movies=pagination.items, pagination=pagination, user=owner, editable=editable)
+
+def dummy_password_hash() -> str:
+    method = current_app.config['PASSWORD_HASH_METHOD']
+    if method not in _dummy_hashes:
+        _dummy_hashes[method] = generate_password_hash('dummy', method=method)
+    return _dummy_hashes[method]
+
+
+@main.route('/', methods=['GET', 'POST'])
+@cached_page
 def index() -> 'html':
     if request.method == 'POST':
         if not current_user.is_authenticated: #判断登录状态
-            return redirect(url_for('index'))
+            return redirect(url_for('.index'))
         title = request.form.get('title')
         year = request.form.get('year')
-        if not title or not year or len(year) > 4 or len(title) > 60:
+        if not title or not year or not year.isdigit() or len(year) > 4 or len(title) > 60:
             flash('请输入适合的字段长度') #显示错误信息
-            return redirect(url_for('index')) #页面重定向
-        movie = Movie(title=title, year=year) #调用model类
+            return redirect(url_for('.index')) #页面重定向
+        movie = Movie(title=title, year=int(year), user_id=current_user.id) #调用model类
         db.session.add(movie)
         db.session.commit()
+        invalidate_movie_pages()
         flash('添加成功')
-        return redirect(url_for('index'))
-    movies = Movie.query.all()
-    return render_template('index.html', movies=movies)
+        return redirect(url_for('.index'))
+    if current_user.is_authenticated: #登录后显示自己的清单，未登录时显示站长的清单
+        user = current_user
+        return render_movies(Owner(user.id, user.name, user.username))
+    return render_movies(get_owner())
+
+@main.route('/u/<username>')
+@cached_page
+def user_movies(username) -> 'html':
+    user = User.query.filter_by(username=username).first_or_404()
+    return render_movies(Owner(user.id, user.name, user.username))
 
-@app.route('/messageboard', methods=['GET', 'POST'])
+@main.route('/messageboard', methods=['GET', 'POST'])
+@cached_page
 def messageboard() -> 'html':
     if request.method == 'POST':
         username = request.form.get('username')
         content = request.form.get('content')
         if not username or not content or len(username) > 20 or len(content) > 200:
             flash('请输入适合的字段长度')
-            return redirect(url_for('messageboard'))
-        messageboard = MessageBoard(username=username, content=content)
-        db.session.add(messageboard)
-        db.session.commit()
+            return redirect(url_for('.messageboard'))
+        burst = current_app.config['MESSAGE_POST_BURST']
+        if burst > 0 and not message_limiter.consume('ip:%s' % request.remote_addr,
+                                                     current_app.config['MESSAGE_POST_RATE'], burst):
+            post_counters.incr('rate_limited')
+            flash('留言太频繁，请稍后再试')
+            return redirect(url_for('.messageboard'))
+        digest = message_hash(username, content)
+        if recent_hashes.get(digest): #最近提交过的内容不查询数据库
+            post_counters.incr('duplicate')
+            flash('请不要重复留言')
+            return redirect(url_for('.messageboard'))
+        if message_writer.enabled:
+            #批量写入模式下记住回执，重定向后的页面先确认自己的留言已写入，重复的留言写入时跳过
+            session['message_receipt'] = message_writer.submit(username, content)
+        else:
+            try:
+                db.session.add(MessageBoard(username=username, content=content, content_hash=digest))
+                db.session.commit()
+            except IntegrityError: #已被挤出最近hash的旧留言，由唯一索引拒绝
+                db.session.rollback()
+                recent_hashes.set(digest, True)
+                post_counters.incr('duplicate')
+                flash('请不要重复留言')
+                return redirect(url_for('.messageboard'))
+            page_cache.invalidate('main.messageboard')
+            message_broker.notify() #通知实时推送
+        recent_hashes.set(digest, True) #写入或进入队列之后才记录，失败时用户可以重试
+        post_counters.incr('accepted')
         flash('添加成功')
-        return redirect(url_for('messageboard'))
-    messageboard = MessageBoard.query.all()
-    return render_template('messages.html', messageboard=messageboard)
+        return redirect(url_for('.messageboard'))
+    if 'message_receipt' in session:
+        message_writer.wait_for(session.pop('message_receipt'))
+    #最新的留言显示在最前面
+    pagination = paginate_keyset(MessageBoard.query, [MessageBoard.ctime, MessageBoard.id], current_app.config['MESSAGES_PER_PAGE'],
+                                 after=request.args.get('after'), before=request.args.get('before'),
+                                 descending=True, total=count_rows(MessageBoard))
+    latest_id = max([message.id for message in pagination.items] or [0])
+    archived = not pagination.has_next and bool(list_segments(current_app.config['ARCHIVE_DIR'])) #最后一页显示归档入口
+    return render_page('messages.html', messageboard=pagination.items, pagination=pagination, latest_id=latest_id,
+                           archived=archived)
+
+@main.route('/messageboard/archive')
+@cached_page
+def message_archive() -> 'html':
+    directory = current_app.config['ARCHIVE_DIR']
+    #新的分段在前，行数和起止时间从index.json读取
+    segments = [(seq,) + segment_summary(directory, seq) for seq in reversed(list_segments(directory))]
+    return render_template('archive.html', segments=segments)
+
+@main.route('/messageboard/archive/<int:seq>')
+@cached_page
+def message_archive_segment(seq) -> 'html':
+    directory = current_app.config['ARCHIVE_DIR']
+    page = request.args.get('page', 1, type=int)
+    if seq not in list_segments(directory) or page < 1:
+        abort(404)
+    per_page = current_app.config['MESSAGES_PER_PAGE']
+    rows = load_segment(directory, seq)
+    #分段按时间从旧到新保存，倒序显示与留言板一致
+    end = len(rows) - (page - 1) * per_page
+    messages = rows[max(0, end - per_page):max(0, end)][::-1]
+    return render_page('archive.html', seq=seq, messageboard=messages, total=len(rows), page=page,
+                           has_next=end - per_page > 0)
+
+@main.route('/messageboard/stream')
+def message_stream():
+    if not current_app.config['SSE_ENABLED']: #WSGI下每个连接占用一个工作线程，需要明确开启
+        abort(404)
+    #浏览器重连时通过Last-Event-ID告知最后收到的留言
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('last_id', type=int)
+    app = current_app._get_current_object()
+    latest = message_broker.subscribe()
+    if since is None:
+        since = latest
+    response = Response(event_stream(app, since), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' #禁止nginx缓冲
+    return response
+
+@main.route('/search')
+def search() -> 'html':
+    q = request.args.get('q', '').strip()
+    kind = request.args.get('kind', 'movie')
+    if kind not in ('movie', 'message'):
+        kind = 'movie'
+    page = request.args.get('page', 1, type=int)
+    results, has_next, limited = [], False, False
+    if q and page > 0:
+        search_func = search_movies if kind == 'movie' else search_messages
+        results, has_next, limited = search_func(q, page, current_app.config['SEARCH_PER_PAGE'])
+    return render_template('search.html', q=q, kind=kind, page=page, results=results, has_next=has_next,
+                           limited=limited)
 
-@app.route('/movie/edit/<int:movie_id>', methods=['GET', 'POST'])
+@main.route('/movie/edit/<int:movie_id>', methods=['GET', 'POST'])
 @login_required
 def edit(movie_id) -> 'html':
-    movie = Movie.query.get_or_404(movie_id) #返回对应主键的记录，如没有则返回404
+    #只能修改自己的电影，其他用户的电影和不存在的一样返回404
+    movie = Movie.query.filter_by(id=movie_id, user_id=current_user.id).first_or_404()
     if request.method == 'POST':
         title = request.form['title']
         year = request.form['year']
-        if not title or not year or len(year) > 4 or len(title) > 60:
+        if not title or not year or not year.isdigit() or len(year) > 4 or len(title) > 60:
             flash('请输入适合的字段长度')
-            return redirect(url_for('edit', movie_id=movie_id))
+            return redirect(url_for('.edit', movie_id=movie_id))
         movie.title = title
-        movie.year = year
+        movie.year = int(year)
         db.session.commit()
+        invalidate_movie_pages()
         flash('更新成功')
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
     return render_template('edit.html', movie=movie)
 
-@app.route('/movie/delete/<int:movie_id>', methods=['POST'])
+@main.route('/movie/delete/<int:movie_id>', methods=['POST'])
 @login_required #登录保护
 def delete(movie_id) -> 'html':
-    movie = Movie.query.get_or_404(movie_id)
+    movie = Movie.query.filter_by(id=movie_id, user_id=current_user.id).first_or_404()
     db.session.delete(movie)
     db.session.commit()
+    invalidate_movie_pages()
     flash('删除成功')
-    return redirect(url_for('index'))
+    return redirect(url_for('.index'))
 
-@app.route('/login', methods=['GET', 'POST'])
+@main.route('/login', methods=['GET', 'POST'])
 def login() -> 'html':
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
         if not username or not password:
             flash('请输入用户名或密码')
-            return redirect(url_for('login'))
-        user = User.query.first()
-        if username == user.username and user.validate_password(password):
+            return redirect(url_for('.login'))
+        rate, burst = current_app.config['LOGIN_FAILURE_RATE'], current_app.config['LOGIN_FAILURE_BURST']
+        keys = ('ip:%s' % request.remote_addr, 'user:%s' % username)
+        #计算hash之前先预留令牌，并发的猜测不能都通过检查；登录成功时退还
+        if not login_limiter.consume_all(keys, rate, burst):
+            flash('尝试次数过多，请稍后再试')
+            return redirect(url_for('.login'))
+        user = User.query.filter_by(username=username).first() #按索引查询
+        if user is not None:
+            valid = user.validate_password(password)
+        else:
+            valid = check_password_hash(dummy_password_hash(), password) #用户不存在时也计算hash，响应时间一致
+        if user is not None and valid: #密码恰好是dummy时hash也能匹配
+            login_limiter.refund(keys, rate, burst)
+            if user.needs_rehash():
+                user.set_password(password)
+                db.session.commit()
             login_user(user)
             flash('登录成功')
-            return redirect(url_for('index'))
+            return redirect(url_for('.index'))
         flash('用户名或密码错误')
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
     return render_template('login.html')
 
-@app.route('/logout')
+@main.route('/logout')
 @login_required
 def logout() -> 'html':
     logout_user()
     flash('再见')
-    return redirect(url_for('index'))
+    return redirect(url_for('.index'))
 
-@app.route('/settings', methods=['GET', 'POST'])
+@main.route('/settings', methods=['GET', 'POST'])
 @login_required
 def settings() -> 'html':
     if request.method == 'POST':
         name = request.form['name']
         if not name or len(name) > 20:
             flash('输入错误')
-            return redirect(url_for('settings'))
+            return redirect(url_for('.settings'))
         current_user.name = name
         db.session.commit()
+        owner_cache.invalidate()
+        page_cache.invalidate() #站长名称显示在所有页面上
         flash('设置更新成功')
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
     return render_template('settings.html')
\ No newline at end of file
@@ -0,0 +1,120 @@
+import re
+import sqlite3
+from flask import current_app
+from sqlalchemy import event
+from watchlist import db
+from watchlist.models import Movie, MessageBoard
+
+
+#SQLite FTS5全文索引，external content表只保存索引，数据仍在原表中，由触发器保持同步
+FTS_TABLES = {
+    'movie': ('movie_fts', ['title']),
+    'message_board': ('message_fts', ['username', 'content']),
+}
+TRIGRAM_MIN_LENGTH = 3 #trigram索引只能匹配至少3个字符的词，更短的词用LIKE过滤
+
+
+def _fts_ddl(table, fts, columns, tokenizer):
+    cols = ', '.join(columns)
+    new = ', '.join('new.%s' % c for c in columns)
+    old = ', '.join('old.%s' % c for c in columns)
+    return [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({cols}, content='{table}', "
+        "content_rowid='id', tokenize='{tokenizer}')",
+        "CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN "
+        "INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {new}); END",
+        "CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN "
+        "INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {old}); END",
+        "CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {cols} ON {table} BEGIN "
+        "INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {old}); "
+        "INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {new}); END",
+    ], dict(table=table, fts=fts, cols=cols, new=new, old=old, tokenizer=tokenizer)
+
+def configured_tokenizer() -> str:
+    if current_app.config['SEARCH_TOKENIZER']:
+        return current_app.config['SEARCH_TOKENIZER']
+    #unicode61把一段连续的中文当作一个词，只能从开头匹配
+    return 'trigram' if sqlite3.sqlite_version_info >= (3, 34, 0) else 'unicode61'
+
+def fts_tokenizer(conn, table):
+    """已有索引表使用的分词器，没有索引表时返回None。"""
+    fts = FTS_TABLES[table][0]
+    sql = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (fts,)).scalar()
+    if sql is None:
+        return None
+    match = re.search(r"tokenize\s*=\s*'([^']*)'", sql)
+    return match.group(1) if match else 'unicode61'
+
+def create_fts(conn, table):
+    fts, columns = FTS_TABLES[table]
+    statements, params = _fts_ddl(table, fts, columns, configured_tokenizer())
+    for statement in statements:
+        conn.execute(statement.format(**params))
+
+def drop_fts(conn, table):
+    #重建原表前调用，删除索引表和触发器
+    fts = FTS_TABLES[table][0]
+    for suffix in ('_ai', '_ad', '_au'):
+        conn.execute('DROP TRIGGER IF EXISTS %s%s' % (fts, suffix))
+    conn.execute('DROP TABLE IF EXISTS %s' % fts)
+
+def rebuild_fts(conn, table):
+    fts = FTS_TABLES[table][0]
+    conn.execute("INSERT INTO {0}({0}) VALUES ('rebuild')".format(fts))
+
+@event.listens_for(Movie.__table__, 'after_create')
+@event.listens_for(MessageBoard.__table__, 'after_create')
+def _after_create(target, connection, **kw): #create_all时自动创建索引表，只对SQLite生效
+    if connection.dialect.name == 'sqlite':
+        create_fts(connection, target.name)
+
+@event.listens_for(Movie.__table__, 'before_drop')
+@event.listens_for(MessageBoard.__table__, 'before_drop')
+def _before_drop(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        drop_fts(connection, target.name)
+
+
+def match_expression(terms, prefix=True) -> str:
+    #每个词加上引号，避免FTS5语法错误，多个词之间为AND；trigram本身就是子串匹配，不需要前缀查询
+    return ' '.join(('"%s"*' if prefix else '"%s"') % term.replace('"', '""') for term in terms)
+
+def _like_filters(columns, terms):
+    return [db.or_(*[column.contains(term, autoescape=True) for column in columns]) for term in terms]
+
+def _search(model, fts, like_columns, q, page, per_page):
+    offset = (page - 1) * per_page
+    terms = q.split()
+    query = None
+    if db.engine.dialect.name == 'sqlite':
+        trigram = fts_tokenizer(db.session.connection(), model.__tablename__) == 'trigram'
+        if trigram:
+            matched = [term for term in terms if len(term) >= TRIGRAM_MIN_LENGTH]
+            terms = [term for term in terms if len(term) < TRIGRAM_MIN_LENGTH]
+        else:
+            matched, terms = terms, []
+        if matched:
+            fts_table = db.table(fts, db.column('rowid'), db.column('rank'))
+            query = model.query.join(fts_table, fts_table.c.rowid == model.id) \
+                .filter(db.text('%s MATCH :q' % fts).bindparams(q=match_expression(matched, not trigram))) \
+                .order_by(fts_table.c.rank)
+    limited = False
+    if query is None: #没有可以用索引匹配的词，按时间倒序
+        query = model.query.order_by(model.id.desc())
+        scan_rows = current_app.config['SEARCH_SCAN_ROWS']
+        if terms and scan_rows > 0:
+            #只有LIKE条件时需要逐行检查，只查找id最大的scan_rows行，耗时不随表的大小增长
+            newest = db.session.query(db.func.max(model.id)).scalar() or 0
+            if newest > scan_rows:
+                query = query.filter(model.id > newest - scan_rows)
+                limited = True
+    #其他数据库和trigram无法匹配的短词退化为LIKE查询，有索引匹配的词时只过滤匹配到的行
+    rows = query.filter(*_like_filters(like_columns, terms)).limit(per_page + 1).offset(offset).all()
+    return rows[:per_page], len(rows) > per_page, limited
+
+def search_movies(q, page, per_page):
+    """按相关度排序返回(当前页电影, 是否有下一页, 是否只查找了最近的行)。"""
+    return _search(Movie, 'movie_fts', [Movie.title], q, page, per_page)
+
+def search_messages(q, page, per_page):
+    return _search(MessageBoard, 'message_fts', [MessageBoard.username, MessageBoard.content], q, page, per_page)
@@ -0,0 +1,42 @@
+import hashlib
+import threading
+from watchlist.lru import LRUCache
+from watchlist.ratelimit import TokenBucketLimiter
+
+
+#匿名留言的写入保护：按客户端限速，重复内容先查最近的hash，再由唯一索引兜底
+
+def message_hash(username, content) -> str:
+    return hashlib.sha1(('%s\0%s' % (username, content)).encode('utf-8')).hexdigest()
+
+
+class PostCounters(object): #留言提交结果计数，在/metrics中输出
+    RESULTS = ('accepted', 'rate_limited', 'duplicate')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def incr(self, result):
+        with self._lock:
+            self._counts[result] += 1
+
+    def reset(self):
+        with self._lock:
+            self._counts = dict.fromkeys(self.RESULTS, 0)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._counts)
+
+    def render(self) -> str:
+        lines = ['# HELP watchlist_message_posts_total Message board posts by result.',
+                 '# TYPE watchlist_message_posts_total counter']
+        for result, count in sorted(self.snapshot().items()):
+            lines.append('watchlist_message_posts_total{result="%s"} %d' % (result, count))
+        return '\n'.join(lines) + '\n'
+
+
+message_limiter = TokenBucketLimiter() #每个客户端的留言令牌桶
+recent_hashes = LRUCache(10000) #已写入的留言内容的hash，重复提交不查询数据库直接拒绝
+post_counters = PostCounters()
@@ -0,0 +1,147 @@
+import json
+import threading
+import time
+from collections import deque
+from flask import current_app
+from werkzeug.local import LocalProxy
+from watchlist import db
+
+
+#留言实时推送：每个进程只有一个线程查询数据库，订阅者共享最近留言的环形缓冲区，
+#每个连接只需要记住自己最后收到的id
+
+def messages_query(since, limit):
+    from watchlist.models import MessageBoard
+    table = MessageBoard.__table__
+    return db.select([table.c.id, table.c.username, table.c.content, table.c.ctime]) \
+        .where(table.c.id > since).order_by(table.c.id).limit(limit) #走主键索引
+
+def event_row(row) -> dict:
+    return dict(id=row.id, username=row.username, content=row.content, ctime=row.ctime.isoformat())
+
+def fetch_messages(since, limit) -> list:
+    return [event_row(row) for row in db.session.execute(messages_query(since, limit))]
+
+def format_event(row) -> str:
+    data = json.dumps(row, ensure_ascii=False, separators=(',', ':'))
+    return 'id: %d\nevent: message\ndata: %s\n\n' % (row['id'], data)
+
+
+class MessageBroker(object): #每个应用一个，保存在app.extensions中
+    def __init__(self, app):
+        self.app = app
+        self._cond = threading.Condition()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._listeners = set() #ASGI订阅者的回调，在查询线程中调用
+        self.reset()
+
+    def reset(self):
+        with self._cond:
+            self._buffer = deque()
+            self._floor = 0 #缓冲区之前的最大id，订阅者的id小于它时需要查询数据库补齐
+            self._last_id = None
+
+    def notify(self):
+        """有新留言写入时调用，立即唤醒查询线程。"""
+        self._wakeup.set()
+
+    def subscribe(self) -> int:
+        """返回当前最新的留言id，并确保查询线程已经启动。"""
+        app = self.app
+        with self._cond:
+            if self._last_id is None:
+                from watchlist.models import MessageBoard
+                self._buffer = deque(maxlen=app.config['SSE_BUFFER_SIZE'])
+                with app.app_context():
+                    self._last_id = self._floor = db.session.query(db.func.max(MessageBoard.id)).scalar() or 0
+                    db.session.remove()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='message-broker', daemon=True)
+                self._thread.start()
+            return self._last_id
+
+    def add_listener(self, callback):
+        with self._cond:
+            self._listeners.add(callback)
+
+    def remove_listener(self, callback):
+        with self._cond:
+            self._listeners.discard(callback)
+
+    def poll(self, since):
+        """不等待，返回id大于since的留言，缓冲区不够时返回None。"""
+        with self._cond:
+            if since < self._floor:
+                return None
+            return [row for row in self._buffer if row['id'] > since]
+
+    def wait(self, since, timeout):
+        """返回id大于since的留言，超时返回空列表，缓冲区不够时返回None。"""
+        with self._cond:
+            if self._last_id is not None and self._last_id <= since:
+                self._cond.wait(timeout)
+            return self.poll(since)
+
+    def publish(self, rows):
+        if not rows:
+            return
+        with self._cond:
+            for row in rows:
+                if len(self._buffer) == self._buffer.maxlen:
+                    self._floor = self._buffer[0]['id']
+                self._buffer.append(row)
+            self._last_id = rows[-1]['id']
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+        for callback in listeners:
+            callback()
+
+    def _poll(self):
+        #所有新留言都按id顺序从数据库读取，包括其他进程写入的留言
+        app = self.app
+        if self._last_id is None:
+            return
+        with app.app_context():
+            try:
+                rows = fetch_messages(self._last_id, app.config['SSE_BUFFER_SIZE'])
+            finally:
+                db.session.remove()
+        self.publish(rows)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.app.config['SSE_POLL_INTERVAL']) #多进程部署时靠定时查询发现新留言
+            self._wakeup.clear()
+            try:
+                self._poll()
+            except Exception:
+                self.app.logger.exception('Failed to poll new messages')
+
+
+message_broker = LocalProxy(lambda: current_app.extensions['message_broker']) #当前应用的推送
+
+def init_stream(app):
+    app.extensions['message_broker'] = MessageBroker(app)
+
+def event_stream(app, since):
+    """生成SSE事件，连接保持SSE_STREAM_TIMEOUT秒后关闭，浏览器会带着Last-Event-ID自动重连。"""
+    broker = app.extensions['message_broker'] #生成器在请求上下文之外继续执行
+    heartbeat = app.config['SSE_HEARTBEAT']
+    deadline = time.monotonic() + app.config['SSE_STREAM_TIMEOUT']
+    yield 'retry: %d\n\n' % app.config['SSE_RETRY_MS']
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        rows = broker.wait(since, min(heartbeat, remaining))
+        if rows is None: #落后太多，直接从数据库补齐
+            with app.app_context():
+                rows = fetch_messages(since, app.config['SSE_BUFFER_SIZE'])
+                db.session.remove()
+        if not rows:
+            yield ': ping\n\n' #心跳，及时发现已断开的连接
+            continue
+        for row in rows:
+            yield format_event(row)
+        since = rows[-1]['id']
@@ -0,0 +1,42 @@
+from flask import Response, current_app, g, render_template, session, stream_with_context
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+from werkzeug.local import LocalProxy
+from watchlist.lru import LRUCache
+
+
+#缓存渲染好的列表行，行更新后updated_at变化，键也随之变化，不需要主动失效，旧版本的行按LRU淘汰
+fragment_cache = LocalProxy(lambda: current_app.extensions['fragment_cache'])
+
+def render_row(template_name, row, **context):
+    """渲染列表中的一行，键为(模板, row.id, row.updated_at, context)，context只能包含可哈希的值。"""
+    max_size = current_app.config['FRAGMENT_CACHE_SIZE']
+    key = (template_name, row.id, row.updated_at, tuple(sorted(context.items())))
+    if max_size > 0:
+        html = fragment_cache.get(key)
+        if html is not None:
+            return html
+    template = current_app.jinja_env.get_template(template_name)
+    #用generate而不是render，行的渲染时间已经包含在整页的渲染时间中
+    html = Markup(''.join(template.generate(row=row, **context)))
+    if max_size > 0:
+        fragment_cache.set(key, html, max_size)
+    return html
+
+def render_page(template_name, **context):
+    """STREAM_TEMPLATES开启时用Template.generate边渲染边发送，首字节更早到达，整页不必同时在内存中。
+    会写入页面缓存的请求仍然整页渲染。"""
+    #响应头发出后不能再修改session，有闪现消息时整页渲染
+    if not current_app.config['STREAM_TEMPLATES'] or g.get('page_cacheable') or session.get('_flashes'):
+        return render_template(template_name, **context)
+    app = current_app._get_current_object()
+    app.update_template_context(context) #与render_template一样注入user、current_user等变量
+    template = app.jinja_env.get_or_select_template(template_name)
+    return Response(stream_with_context(template.generate(context)), mimetype='text/html')
+
+def init_templates(app):
+    app.extensions['fragment_cache'] = LRUCache()
+    if app.config['TEMPLATE_BYTECODE_CACHE']:
+        #编译后的字节码保存在磁盘上，新启动的worker进程直接加载，不需要重新编译模板
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['TEMPLATE_CACHE_DIR'] or None)
+    app.jinja_env.globals['render_row'] = render_row
@@ -0,0 +1,135 @@
+import csv
+import json
+from datetime import datetime
+from itertools import islice
+from watchlist import db
+from watchlist.spam import message_hash
+
+
+#导入导出都以生成器逐行处理，内存占用只与分块大小有关，与文件大小无关
+
+def detect_format(filename, fmt=None) -> str:
+    if fmt:
+        return fmt
+    return 'csv' if filename.lower().endswith('.csv') else 'jsonl'
+
+def read_rows(stream, fmt):
+    if fmt == 'csv':
+        for row in csv.DictReader(stream):
+            yield row
+    else:
+        for line in stream:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+def write_rows(stream, rows, fields, fmt) -> int:
+    count = 0
+    if fmt == 'csv':
+        writer = csv.DictWriter(stream, fieldnames=fields, extrasaction='ignore', lineterminator='\n')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    else:
+        for row in rows:
+            stream.write(json.dumps(row, ensure_ascii=False, separators=(',', ':')))
+            stream.write('\n')
+            count += 1
+    return count
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def bulk_insert(model, rows, chunk_size=1000) -> int:
+    """每个分块用一条executemany语句插入并提交一次。"""
+    statement = model.__table__.insert()
+    count = 0
+    for chunk in chunked(rows, chunk_size):
+        db.session.execute(statement, chunk)
+        db.session.commit()
+        count += len(chunk)
+    return count
+
+def iter_table(model, columns, chunk_size=1000):
+    #按主键分块查询，不在内存中保留整张表，也不长时间占用读游标
+    table = model.__table__
+    last_id = None
+    while True:
+        query = db.select([table.c[name] for name in columns]).order_by(table.c.id).limit(chunk_size)
+        if last_id is not None:
+            query = query.where(table.c.id > last_id)
+        rows = db.session.execute(query).fetchall()
+        if not rows:
+            return
+        for row in rows:
+            yield dict((name, _dump_value(row[name])) for name in columns)
+        last_id = rows[-1]['id']
+
+def _dump_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+def owner_usernames(rows):
+    """把导出行中的user_id换成用户名，导入到用户id不同的数据库时仍能找到主人。"""
+    from watchlist.models import User
+    usernames = {}
+    for row in rows:
+        user_id = row.pop('user_id')
+        if user_id not in usernames:
+            usernames[user_id] = db.session.query(User.username).filter_by(id=user_id).scalar()
+        row['owner'] = usernames[user_id]
+        yield row
+
+def owner_lookup():
+    """返回按用户名查询用户id的函数，每个用户名只查询一次。"""
+    from watchlist.models import User
+    user_ids = {}
+    def lookup(username):
+        if username not in user_ids:
+            user_ids[username] = db.session.query(User.id).filter_by(username=username).scalar()
+        return user_ids[username]
+    return lookup
+
+def movie_rows(rows, user_id=None, lookup=None):
+    """lookup不为None时，有owner列的行属于该用户，没有owner列的行属于user_id。"""
+    for row in rows:
+        title = row.get('title')
+        year = str(row.get('year') or '')
+        if not title or not year.isdigit() or len(year) > 4 or len(title) > 60:
+            raise ValueError('Invalid movie row: %r' % (row,))
+        owner_id = user_id
+        if lookup is not None and row.get('owner'):
+            owner_id = lookup(row['owner'])
+            if owner_id is None:
+                raise ValueError('Unknown owner in movie row: %r' % (row,))
+        yield dict(title=title, year=int(year), user_id=owner_id)
+
+def message_rows(rows):
+    for row in rows:
+        username = row.get('username')
+        content = row.get('content')
+        if not username or not content or len(username) > 20 or len(content) > 200:
+            raise ValueError('Invalid message row: %r' % (row,))
+        ctime = row.get('ctime')
+        ctime = datetime.fromisoformat(ctime) if ctime else datetime.now()
+        yield dict(username=username, content=content, ctime=ctime)
+
+def message_hashes(rows, chunk_size=1000):
+    """填写content_hash，与已有留言或同一分块中前面的行重复时留空，与migratedb的add_content_hash一致，
+    历史上重复的留言也会导入。分块大小需与bulk_insert相同，前面的分块查询时已经提交。"""
+    from watchlist.models import MessageBoard
+    column = MessageBoard.__table__.c.content_hash
+    for chunk in chunked(rows, chunk_size):
+        digests = [message_hash(row['username'], row['content']) for row in chunk]
+        existing = set(row[0] for row in db.session.execute(db.select([column]).where(column.in_(set(digests)))))
+        for row, digest in zip(chunk, digests):
+            row['content_hash'] = None if digest in existing else digest
+            existing.add(digest)
+            yield row
@@ -0,0 +1,148 @@
+import atexit
+import os
+import threading
+import time
+from datetime import datetime
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from watchlist.spam import message_hash
+
+
+class MessageWriter(object): #Flask扩展，每个应用的队列保存在app.extensions中，同一进程中的多个应用互不影响
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['message_writer'] = MessageQueue(app)
+
+    @staticmethod
+    def queue(app=None) -> 'MessageQueue':
+        """app的留言队列，没有传入app时使用当前应用。"""
+        return (app if app is not None else current_app).extensions['message_writer']
+
+    @property
+    def enabled(self) -> bool:
+        return self.queue().enabled
+
+    def submit(self, username, content) -> list:
+        return self.queue().submit(username, content)
+
+    def wait_for(self, receipt):
+        self.queue().wait_for(receipt)
+
+    def flush(self) -> int:
+        return self.queue().flush()
+
+
+class MessageQueue(object): #把留言先放入内存队列，按批次在一个事务中写入数据库
+    def __init__(self, app):
+        self.app = app
+        self._lock = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._pending = [] #(序号, 行, 已失败的次数)
+        self._submitted = 0 #已提交到队列的留言序号
+        self._flushed = 0 #已写入数据库的留言序号
+        self._thread = None
+        atexit.register(self.flush) #进程退出前写入队列中剩余的留言
+
+    @property
+    def enabled(self) -> bool:
+        return self.app.config['MESSAGE_BATCH_ENABLED']
+
+    def submit(self, username, content) -> list:
+        """加入队列并返回回执[进程id, 序号, 内容hash]，可用wait_for(回执)确认已写入数据库。"""
+        digest = message_hash(username, content)
+        row = dict(username=username, content=content, ctime=datetime.now(), content_hash=digest) #按提交时间排序
+        with self._lock:
+            self._submitted += 1
+            self._pending.append((self._submitted, row, 0))
+            seq = self._submitted
+            if self._thread is None or not self._thread.is_alive():
+                #在第一次写入时启动线程，预先fork的worker进程各自拥有自己的线程
+                self._thread = threading.Thread(target=self._run, name='message-writer', daemon=True)
+                self._thread.start()
+            if len(self._pending) >= self.app.config['MESSAGE_BATCH_SIZE']:
+                self._lock.notify()
+        return [os.getpid(), seq, digest]
+
+    def wait_for(self, receipt):
+        """读到自己的留言：序号是本进程的就立即写入队列，否则等待其他worker进程写入这条留言。"""
+        pid, seq, digest = receipt
+        try:
+            if pid != os.getpid(): #序号只在提交留言的进程内有意义
+                self._wait_for_row(digest)
+            elif self._flushed < seq:
+                self.flush()
+        except Exception: #写入失败时照常显示页面，留言留在队列中重试
+            self.app.logger.exception('Failed to write queued messages')
+
+    def _wait_for_row(self, digest):
+        from watchlist import db
+        from watchlist.models import MessageBoard
+        deadline = time.monotonic() + self.app.config['MESSAGE_BATCH_WAIT']
+        while db.session.query(MessageBoard.id).filter_by(content_hash=digest).first() is None:
+            db.session.rollback() #结束读事务，下次查询才能看到其他进程新提交的行
+            if time.monotonic() >= deadline:
+                return
+            time.sleep(0.05)
+
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            rows = [row for seq, row, failures in batch]
+            try:
+                try:
+                    self._write(rows)
+                except IntegrityError:
+                    #只有SQLite支持OR IGNORE，其他数据库上逐行写入，跳过重复的留言，不让整批失败
+                    self._write_each(rows)
+            except Exception:
+                self._retry(batch)
+                raise
+            self._flushed = batch[-1][0]
+            return len(batch)
+
+    def _write_each(self, rows):
+        for row in rows:
+            try:
+                self._write([row])
+            except IntegrityError:
+                self.app.logger.warning('Dropped duplicate message from %s', row['username'])
+
+    def _retry(self, batch):
+        #写入失败时放回队列，下一批次重试；多次失败的留言丢弃，不能让它挡住之后的留言
+        retry = []
+        for seq, row, failures in batch:
+            if failures + 1 >= self.app.config['MESSAGE_BATCH_RETRIES']:
+                self.app.logger.error('Dropped message %d from %s after %d failed writes',
+                                      seq, row['username'], failures + 1)
+            else:
+                retry.append((seq, row, failures + 1))
+        with self._lock:
+            self._pending[:0] = retry
+        if not retry:
+            self._flushed = batch[-1][0]
+
+    def _write(self, rows):
+        from watchlist import db
+        from watchlist.models import MessageBoard
+        with self.app.app_context():
+            with db.engine.begin() as conn: #一批留言只提交一次事务
+                #队列中的重复留言跳过，不让整批失败
+                conn.execute(MessageBoard.__table__.insert().prefix_with('OR IGNORE', dialect='sqlite'), rows)
+        self.app.extensions['page_cache'].invalidate('main.messageboard') #写入后再让缓存失效，避免缓存到尚未写入的页面
+        self.app.extensions['message_broker'].notify()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if len(self._pending) < self.app.config['MESSAGE_BATCH_SIZE']:
+                    self._lock.wait(self.app.config['MESSAGE_BATCH_INTERVAL'])
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Failed to write message batch')